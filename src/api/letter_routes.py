@@ -3,9 +3,12 @@ API Routes for Letter Generation
 Handles all letter generation related endpoints with proper validation and error handling.
 """
 
+import json
+import asyncio
 import logging
-from typing import Dict, Any
-from flask import Blueprint, request, jsonify
+import threading
+from typing import Dict, Any, AsyncIterator, Iterator, Optional
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from pydantic import ValidationError
 
 from ..models import (
@@ -59,37 +62,8 @@ def generate_letter():
                     "details": e.errors()
                 }), 400
             
-            # Get letter configuration
-            try:
-                sheets_service = get_sheets_service()
-                letter_config = sheets_service.get_letter_config_by_category(
-                    letter_request.category.value,
-                    letter_request.member_name or ""
-                )
-            except Exception as e:
-                logger.warning(f"Could not fetch letter config: {e}")
-                letter_config = {
-                    "letter": "",
-                    "instruction": "اكتب خطاباً رسمياً باللغة العربية",
-                    "member_info": ""
-                }
-            
             # Create generation context
-            context = LetterGenerationContext(
-                user_prompt=letter_request.prompt,
-                recipient=letter_request.recipient,
-                member_info=letter_config.get("member_info", "غير محدد"),
-                is_first_contact=letter_request.is_first,
-                reference_letter=letter_config.get("letter"),
-                category=letter_request.category.value,
-                writing_instructions=letter_config.get("instruction"),
-                recipient_title=letter_request.recipient_title,
-                recipient_job_title=letter_request.recipient_job_title,
-                organization_name=letter_request.organization_name,
-                previous_letter_content=letter_request.previous_letter_content,
-                previous_letter_id=letter_request.previous_letter_id,
-                session_id=letter_request.session_id
-            )
+            context = _build_generation_context(letter_request)
             
             # Generate letter
             letter_service = get_letter_service()
@@ -106,6 +80,135 @@ def generate_letter():
             logger.error(f"Letter generation failed: {e}")
             return jsonify(build_error_response(e)), 500
 
+@letter_bp.route('/generate/stream', methods=['POST'])
+def generate_letter_stream():
+    """
+    Generate a new letter and stream its body as Server-Sent Events.
+    
+    Request Body:
+        GenerateLetterRequest: Letter generation parameters
+        
+    Returns:
+        text/event-stream of letter fragments, followed by a "done" event
+        carrying the full LetterOutput (or an "error" event on failure)
+    """
+    with ErrorContext("generate_letter_stream_api"):
+        if not request.is_json:
+            return jsonify({"error": "يجب أن يكون الطلب بصيغة JSON"}), 400
+        
+        data = request.get_json()
+        if not data:
+            return jsonify({"error": "لم يتم تقديم بيانات JSON"}), 400
+        
+        try:
+            letter_request = GenerateLetterRequest(**data)
+        except ValidationError as e:
+            logger.warning(f"Validation error in letter streaming: {e}")
+            return jsonify({
+                "error": "بيانات الطلب غير صحيحة",
+                "details": e.errors()
+            }), 400
+        
+        try:
+            context = _build_generation_context(letter_request)
+            letter_service = get_letter_service()
+        except Exception as e:
+            logger.error(f"Letter streaming setup failed: {e}")
+            return jsonify(build_error_response(e)), 500
+    
+    def event_stream() -> Iterator[str]:
+        try:
+            for item in _iterate_async(letter_service.astream_letter(context)):
+                if isinstance(item, LetterOutput):
+                    # Same payload as /generate, so clients get the title and date too
+                    yield _sse_event("done", item.model_dump())
+                else:
+                    yield _sse_event("delta", {"text": item})
+        except Exception as e:
+            logger.error(f"Letter streaming failed: {e}")
+            yield _sse_event("error", build_error_response(e))
+    
+    return Response(
+        stream_with_context(event_stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _build_generation_context(letter_request: GenerateLetterRequest) -> LetterGenerationContext:
+    """Build the letter generation context for a validated request."""
+    # Get letter configuration
+    try:
+        sheets_service = get_sheets_service()
+        letter_config = sheets_service.get_letter_config_by_category(
+            letter_request.category.value,
+            letter_request.member_name or ""
+        )
+    except Exception as e:
+        logger.warning(f"Could not fetch letter config: {e}")
+        letter_config = {
+            "letter": "",
+            "instruction": "اكتب خطاباً رسمياً باللغة العربية",
+            "member_info": ""
+        }
+    
+    return LetterGenerationContext(
+        user_prompt=letter_request.prompt,
+        recipient=letter_request.recipient,
+        member_info=letter_config.get("member_info", "غير محدد"),
+        is_first_contact=letter_request.is_first,
+        reference_letter=letter_config.get("letter"),
+        category=letter_request.category.value,
+        writing_instructions=letter_config.get("instruction"),
+        recipient_title=letter_request.recipient_title,
+        recipient_job_title=letter_request.recipient_job_title,
+        organization_name=letter_request.organization_name,
+        previous_letter_content=letter_request.previous_letter_content,
+        previous_letter_id=letter_request.previous_letter_id,
+        session_id=letter_request.session_id,
+        cache_bypass=letter_request.cache_bypass
+    )
+
+# Streams share one long-lived event loop: the model's async HTTP client pools
+# connections per loop, so a loop per request would leave them on closed loops
+_stream_loop: Optional[asyncio.AbstractEventLoop] = None
+_stream_loop_lock = threading.Lock()
+
+def _get_stream_loop() -> asyncio.AbstractEventLoop:
+    """Get the background event loop that drives streamed generations, starting it on first use."""
+    global _stream_loop
+    with _stream_loop_lock:
+        if _stream_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="letter-stream-loop", daemon=True).start()
+            _stream_loop = loop
+        return _stream_loop
+
+async def _anext(async_iterator: AsyncIterator[Any]) -> Any:
+    """Await the next item of an async iterator (run_coroutine_threadsafe needs a coroutine)."""
+    return await async_iterator.__anext__()
+
+async def _aclose(async_iterator: AsyncIterator[Any]) -> None:
+    """Close an async generator so its cleanup runs on the loop it belongs to."""
+    await async_iterator.aclose()
+
+def _iterate_async(async_iterator: AsyncIterator[Any]) -> Iterator[Any]:
+    """Drive an async iterator from synchronous (WSGI) code on the shared streaming loop."""
+    loop = _get_stream_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(_anext(async_iterator), loop).result()
+            except StopAsyncIteration:
+                break
+    finally:
+        # Each step completes before it is yielded, so on a client disconnect (GeneratorExit
+        # at the yield) no step is in flight and the generator can be closed safely
+        asyncio.run_coroutine_threadsafe(_aclose(async_iterator), loop).result()
+
+def _sse_event(event: str, payload: Dict[str, Any]) -> str:
+    """Format a single Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False, default=str)}\n\n"
+
 @letter_bp.route('/validate', methods=['POST'])
 @measure_performance
 def validate_letter():
@@ -31,6 +31,14 @@ class AIConfig:
     timeout: int = 30
     max_retries: int = 3
     max_tokens: Optional[int] = None
+    structured_output: bool = True  # Use native JSON-schema responses when the model supports them
+    max_keepalive_connections: int = 32
+    max_connections: int = 64
+    response_cache: bool = field(default_factory=lambda: os.getenv("ENABLE_RESPONSE_CACHE", "false").lower() == "true")
+    semantic_cache: bool = field(default_factory=lambda: os.getenv("ENABLE_SEMANTIC_CACHE", "false").lower() == "true")
+    semantic_cache_threshold: float = 0.95
+    semantic_cache_size: int = 10_000
+    embedding_model: str = "text-embedding-3-small"
     
     def __post_init__(self):
         """Validate AI configuration."""
@@ -63,6 +71,8 @@ class StorageConfig:
     service_account_file: str = "automating-letter-creations.json"
     pdf_template_dir: str = "LetterToPdf/templates"
     default_template: str = "default_template.html"
+    response_cache_file: str = "data/letter_cache.db"
+    response_cache_ttl_hours: int = 24
     
     def __post_init__(self):
         """Validate storage configuration."""
@@ -13,6 +13,7 @@ from .schemas import (
     
     # Response Models
     LetterOutput,
+    LetterBatchOutput,
     EditLetterResponse,
     ChatResponse,
     ChatEditResponse,
@@ -50,6 +51,7 @@ __all__ = [
     
     # Response Models
     "LetterOutput",
+    "LetterBatchOutput",
     "EditLetterResponse",
     "ChatResponse",
     "ChatEditResponse", 
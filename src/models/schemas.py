@@ -5,7 +5,7 @@ Pydantic models for request/response validation and data structure.
 
 from datetime import datetime
 from typing import Optional, Dict, Any, List
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field, RootModel, validator
 from enum import Enum
 
 class LetterCategory(str, Enum):
@@ -47,6 +47,7 @@ class GenerateLetterRequest(BaseModel):
     previous_letter_content: Optional[str] = Field(None, max_length=5000)
     previous_letter_id: Optional[str] = Field(None, max_length=50)
     session_id: Optional[str] = Field(None, max_length=50, description="Optional session ID for memory context")
+    cache_bypass: bool = Field(default=False, description="Skip the response cache, e.g. when regenerating a letter")
     
     @validator('prompt')
     def validate_prompt(cls, v):
@@ -152,6 +153,10 @@ class LetterOutput(BaseModel):
     Letter: str = Field(..., description="Full content of the letter in formal Arabic")
     Date: str = Field(..., description="Date the letter was generated")
 
+class LetterBatchOutput(RootModel[List[LetterOutput]]):
+    """Response model for several letters generated in a single AI call."""
+    root: List[LetterOutput] = Field(..., description="Generated letters in request order")
+
 class EditLetterResponse(BaseModel):
     """Response model for letter editing."""
     status: str = Field(..., description="Operation status")
@@ -24,6 +24,7 @@ from .chat_service import ChatService, get_chat_service
 from .memory_service import MemoryService, get_memory_service
 from .session_storage import SessionStorage, get_session_storage
 from .session_manager import SessionManager, get_session_manager
+from .response_cache import LetterResponseCache, SemanticLetterCache, get_response_cache, get_semantic_cache
 
 __all__ = [
     # Letter Generation
@@ -64,6 +65,12 @@ __all__ = [
     "SessionManager", 
     "get_session_manager",
     
+    # Response Cache
+    "LetterResponseCache",
+    "SemanticLetterCache",
+    "get_response_cache",
+    "get_semantic_cache",
+    
     # Helper Functions
     "get_letter_config_by_category",
     "log",
@@ -3,10 +3,8 @@ Enhanced Chat Service
 Provides session-based chat functionality with memory management for letter editing.
 """
 
-import json
 import logging
 import os
-import shutil
 import threading
 import uuid
 from datetime import datetime, timedelta
@@ -14,6 +12,8 @@ from typing import Dict, Any, List, Optional
 from dataclasses import dataclass, field
 from threading import Lock
 
+import orjson
+
 from ..config import get_config
 from ..models import ChatEditResponse, ChatSessionStatus
 from ..services import get_letter_service, LetterGenerationContext
@@ -193,8 +193,8 @@ class ChatService:
         """Load sessions from JSON file."""
         try:
             if os.path.exists(self.sessions_file):
-                with open(self.sessions_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                with open(self.sessions_file, 'rb') as f:
+                    data = orjson.loads(f.read())
                     for session_data in data.values():
                         session = ChatSession.from_dict(session_data)
                         self.sessions[session.session_id] = session
@@ -216,11 +216,11 @@ class ChatService:
             
             # Use temporary file and atomic rename for thread safety
             temp_file = self.sessions_file + '.tmp'
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(sessions_data, f, ensure_ascii=False, indent=2)
+            with open(temp_file, 'wb') as f:
+                f.write(orjson.dumps(sessions_data, option=orjson.OPT_INDENT_2))
             
             # Atomic rename (works on both Windows and Unix)
-            shutil.move(temp_file, self.sessions_file)
+            os.replace(temp_file, self.sessions_file)
             logger.debug(f"Successfully saved {len(sessions_data)} sessions to file")
                 
         except Exception as e:
@@ -424,7 +424,9 @@ class ChatService:
                     category="تحرير",
                     writing_instructions="قم بتحرير الخطاب وفقاً للطلب مع المحافظة على الطابع الرسمي",
                     previous_letter_content=current_letter,
-                    session_id=session_id
+                    session_id=session_id,
+                    # Repeated edit requests must produce a fresh edit, never a cached one
+                    cache_bypass=True
                 )
                 
                 # Generate edited letter
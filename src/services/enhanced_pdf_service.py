@@ -3,14 +3,20 @@ Enhanced PDF Generation Service using AI and Playwright
 Handles PDF creation from letter content with customizable templates.
 """
 
+import base64
 import logging
 import os
+import re
 import tempfile
+import threading
+import time
 import uuid
 import asyncio
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from mimetypes import guess_type
 from pathlib import Path
-from typing import Dict, Any, List, Optional, NamedTuple
+from typing import Dict, Any, List, Optional, NamedTuple, Tuple
 from jinja2 import Environment, FileSystemLoader
 import openai
 import pytz
@@ -28,6 +34,19 @@ from ..utils import (
 
 logger = logging.getLogger(__name__)
 
+# Patterns applied to every generated document
+_CSS_LINK_RE = re.compile(r'<link\s+rel=["\']stylesheet["\']\s+href=["\']default_template\.css["\']>')
+_IMG_TAG_RE = re.compile(r'<img\s+[^>]*src=["\']([^"\']+)["\'][^>]*>')
+_IMG_SRC_RE = re.compile(r'src=["\'][^"\']+["\']')
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\s-]')
+_ARABIC_RE = re.compile(r'[\u0600-\u06FF]+')
+
+# How long the templates directory scan is reused in service stats
+TEMPLATE_SCAN_TTL_SECONDS = 30
+
+# Letter dates are stamped in Saudi time
+_KSA_TZ = pytz.timezone('Asia/Riyadh')
+
 class PDFInfo(NamedTuple):
     """Information about a generated PDF."""
     pdf_id: str
@@ -65,8 +84,15 @@ class EnhancedPDFService:
             autoescape=True
         )
         
-        # PDF storage (in production, use database)
-        self._pdf_cache: Dict[str, PDFInfo] = {}
+        # Template/CSS text keyed by path, with the mtime it was read at
+        self._template_cache: Dict[Path, Tuple[int, str]] = {}
+        self._template_count: Optional[int] = None
+        self._template_count_at = 0.0
+        
+        # PDF storage (in production, use database); insertion order is generation order
+        self._pdf_cache: "OrderedDict[str, PDFInfo]" = OrderedDict()
+        # Guards the cache and stats: requests generate PDFs concurrently on the shared instance
+        self._lock = threading.Lock()
         
         # Service stats
         self._generation_count = 0
@@ -78,8 +104,7 @@ class EnhancedPDFService:
         """Get current date in both Gregorian (KSA timezone) and Hijri formats."""
         try:
             # Get current date in KSA timezone (UTC+3)
-            ksa_tz = pytz.timezone('Asia/Riyadh')
-            now_ksa = datetime.now(ksa_tz)
+            now_ksa = datetime.now(_KSA_TZ)
             
             # Format Gregorian date
             gregorian_date = now_ksa.strftime("%Y/%m/%d")
@@ -105,6 +130,18 @@ class EnhancedPDFService:
                 "hijri_arabic": f"{now.day} / {now.month} / {now.year}"
             }
     
+    def _read_template_file(self, path: Path) -> str:
+        """Read a template or CSS file, reusing the cached text until the file changes."""
+        mtime = path.stat().st_mtime_ns
+        cached = self._template_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with open(path, "r", encoding="utf-8") as file:
+            content = file.read()
+        self._template_cache[path] = (mtime, content)
+        return content
+
     def load_template(self, template_filename: str = "default_template.html") -> str:
         """Load HTML template from file."""
         try:
@@ -112,8 +149,7 @@ class EnhancedPDFService:
             if not template_path.exists():
                 raise FileNotFoundError(f"Template not found: {template_filename}")
 
-            with open(template_path, "r", encoding="utf-8") as file:
-                return file.read()
+            return self._read_template_file(template_path)
         except Exception as e:
             logger.error(f"Error loading template {template_filename}: {e}")
             raise
@@ -125,8 +161,7 @@ class EnhancedPDFService:
             if not css_path.exists():
                 raise FileNotFoundError(f"CSS file not found: {css_filename}")
 
-            with open(css_path, "r", encoding="utf-8") as file:
-                return file.read()
+            return self._read_template_file(css_path)
         except Exception as e:
             logger.error(f"Error loading CSS {css_filename}: {e}")
             raise
@@ -142,10 +177,8 @@ class EnhancedPDFService:
             return html_content.replace(css_link_pattern, embedded_css)
 
         # Try with different spacing/formatting
-        import re
-        link_pattern = r'<link\s+rel=["\']stylesheet["\']\s+href=["\']default_template\.css["\']>'
-        if re.search(link_pattern, html_content):
-            return re.sub(link_pattern, embedded_css, html_content)
+        if _CSS_LINK_RE.search(html_content):
+            return _CSS_LINK_RE.sub(lambda _: embedded_css, html_content)
 
         # If no link found, add styles in the head section
         head_end = '</head>'
@@ -161,13 +194,6 @@ class EnhancedPDFService:
 
     def embed_images_in_html(self, html_content: str) -> str:
         """Convert image src paths to base64 data URLs."""
-        import re
-        import base64
-        from mimetypes import guess_type
-
-        # Find all img tags with src attributes
-        img_pattern = r'<img\s+[^>]*src=["\']([^"\']+)["\'][^>]*>'
-
         def replace_image(match):
             full_tag = match.group(0)
             src_path = match.group(1)
@@ -210,7 +236,7 @@ class EnhancedPDFService:
                 data_url = f'data:{mime_type};base64,{base64_data}'
 
                 # Replace src in the original tag
-                new_tag = re.sub(r'src=["\'][^"\']+["\']', f'src="{data_url}"', full_tag)
+                new_tag = _IMG_SRC_RE.sub(lambda _: f'src="{data_url}"', full_tag)
                 logger.debug(f"Embedded image: {src_path} -> data URL")
                 return new_tag
 
@@ -219,7 +245,7 @@ class EnhancedPDFService:
                 return full_tag
 
         # Replace all image tags
-        return re.sub(img_pattern, replace_image, html_content)
+        return _IMG_TAG_RE.sub(replace_image, html_content)
     
     def fill_template_with_ai(self, html_template: str, letter_text: str = "", letter_id: str = "") -> str:
         """Fill HTML template with letter content using AI."""
@@ -328,9 +354,8 @@ Return only the filled HTML template with ALL letter content preserved:"""
             pdf_id = generate_letter_id()
             
             # Sanitize filename - remove Arabic characters and special characters
-            import re
-            safe_title = re.sub(r'[^\w\s-]', '', title.replace(' ', '_'))
-            safe_title = re.sub(r'[\u0600-\u06FF]+', 'doc', safe_title)  # Replace Arabic characters with 'doc'
+            safe_title = _UNSAFE_FILENAME_RE.sub('', title.replace(' ', '_'))
+            safe_title = _ARABIC_RE.sub('doc', safe_title)  # Replace Arabic characters with 'doc'
             if not safe_title or safe_title.isspace():
                 safe_title = "document"
             
@@ -353,11 +378,12 @@ Return only the filled HTML template with ALL letter content preserved:"""
                     # Embed images as base64
                     html_with_styles = self.embed_images_in_html(html_with_styles)
 
-                    # Save debug HTML file
-                    debug_path = self.output_dir / f"debug_output_{pdf_id}.html"
-                    with open(debug_path, "w", encoding="utf-8") as f:
-                        f.write(html_with_styles)
-                    logger.info(f"Debug HTML file created: {debug_path}")
+                    # Save debug HTML file (only when debugging: it holds every embedded image)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        debug_path = self.output_dir / f"debug_output_{pdf_id}.html"
+                        with open(debug_path, "w", encoding="utf-8") as f:
+                            f.write(html_with_styles)
+                        logger.debug(f"Debug HTML file created: {debug_path}")
 
                 except Exception as e:
                     logger.warning(f"Could not embed CSS/images, using original HTML: {e}")
@@ -378,18 +404,19 @@ Return only the filled HTML template with ALL letter content preserved:"""
                     generated_at=datetime.now()
                 )
                 
-                # Cache PDF info
-                self._pdf_cache[pdf_id] = PDFInfo(
-                    pdf_id=pdf_id,
-                    filename=filename,
-                    file_path=str(output_path),
-                    file_size=file_size,
-                    generated_at=result.generated_at
-                )
-                
-                # Update stats
-                self._generation_count += 1
-                self._total_size += file_size
+                with self._lock:
+                    # Cache PDF info
+                    self._pdf_cache[pdf_id] = PDFInfo(
+                        pdf_id=pdf_id,
+                        filename=filename,
+                        file_path=str(output_path),
+                        file_size=file_size,
+                        generated_at=result.generated_at
+                    )
+                    
+                    # Update stats
+                    self._generation_count += 1
+                    self._total_size += file_size
                 
                 logger.info(f"PDF generated successfully: {filename} ({file_size} bytes) in {timer.elapsed():.2f}s")
                 return result
@@ -418,10 +445,26 @@ Return only the filled HTML template with ALL letter content preserved:"""
                 "cached_pdfs": len(self._pdf_cache),
                 "output_directory": str(self.output_dir),
                 "templates_directory": str(self.templates_dir),
-                "templates_available": len(list(self.templates_dir.glob("*.html"))) if self.templates_dir.exists() else 0
+                "templates_available": self._count_templates()
             }
         }
     
+    def _count_templates(self) -> int:
+        """Count HTML templates with one directory read, reusing the count for TEMPLATE_SCAN_TTL_SECONDS."""
+        now = time.monotonic()
+        if self._template_count is not None and now - self._template_count_at < TEMPLATE_SCAN_TTL_SECONDS:
+            return self._template_count
+        
+        try:
+            with os.scandir(self.templates_dir) as entries:
+                count = sum(1 for entry in entries if entry.name.endswith(".html") and entry.is_file())
+        except FileNotFoundError:
+            count = 0
+        
+        self._template_count = count
+        self._template_count_at = now
+        return count
+    
     def cleanup_old_pdfs(self, max_age_hours: int = 24) -> int:
         """
         Clean up old PDF files.
@@ -435,32 +478,36 @@ Return only the filled HTML template with ALL letter content preserved:"""
         cleaned_count = 0
         cutoff_time = datetime.now() - timedelta(hours=max_age_hours)
         
-        # Clean cache
-        to_remove = []
-        for pdf_id, info in self._pdf_cache.items():
-            if info.generated_at < cutoff_time:
-                to_remove.append(pdf_id)
-                # Try to remove file
-                try:
-                    if os.path.exists(info.file_path):
-                        os.remove(info.file_path)
-                        cleaned_count += 1
-                except Exception as e:
-                    logger.warning(f"Could not remove old PDF file {info.file_path}: {e}")
+        # Clean cache: entries are in generation order, so the expired ones are a prefix
+        expired = []
+        with self._lock:
+            while self._pdf_cache:
+                info = next(iter(self._pdf_cache.values()))
+                if info.generated_at >= cutoff_time:
+                    break
+                expired.append(self._pdf_cache.popitem(last=False)[1])
         
-        # Remove from cache
-        for pdf_id in to_remove:
-            del self._pdf_cache[pdf_id]
+        for info in expired:
+            # Try to remove file
+            try:
+                os.remove(info.file_path)
+                cleaned_count += 1
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"Could not remove old PDF file {info.file_path}: {e}")
         
         logger.info(f"Cleaned up {cleaned_count} old PDF files")
         return cleaned_count
 
 # Service instance
 _enhanced_pdf_service = None
+_enhanced_pdf_service_lock = threading.Lock()
 
 def get_enhanced_pdf_service() -> EnhancedPDFService:
     """Get or create enhanced PDF service instance."""
     global _enhanced_pdf_service
-    if _enhanced_pdf_service is None:
-        _enhanced_pdf_service = EnhancedPDFService()
-    return _enhanced_pdf_service
+    with _enhanced_pdf_service_lock:
+        if _enhanced_pdf_service is None:
+            _enhanced_pdf_service = EnhancedPDFService()
+        return _enhanced_pdf_service
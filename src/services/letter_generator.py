@@ -3,30 +3,93 @@ Refactored AI Letter Generation Service
 Enhanced version of the original ai_generator.py with better error handling and structure.
 """
 
+import re
+import json
+import hashlib
 import logging
+import threading
 from datetime import datetime
-from typing import Optional, Dict, Any
-from dataclasses import dataclass
+from typing import Optional, Dict, Any, List, Tuple, Union, AsyncIterator
+from dataclasses import dataclass, asdict
+from functools import lru_cache
 
+import httpx
 from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.output_parsers import JsonOutputParser, PydanticOutputParser
 from langchain_core.runnables import Runnable
 
+from .memory_service import MemoryCache, get_memory_service
+from .response_cache import get_response_cache, get_semantic_cache
 from ..config import get_config
-from ..models import LetterOutput, LetterCategory
+from ..models import LetterOutput, LetterBatchOutput, LetterCategory
 from ..utils import (
     generate_letter_id, 
     get_current_arabic_date,
-    handle_ai_service_errors,
-    measure_performance,
-    ErrorContext,
+    instrument,
+    tag_operation,
     AIServiceError,
     ValidationError
 )
 
 logger = logging.getLogger(__name__)
 
+# How long formatted memory instructions are reused before being rebuilt
+MEMORY_INSTRUCTIONS_TTL_SECONDS = 60
+
+# How long the first-contact intro text from the Intro worksheet is reused
+INTRO_TEXT_TTL_SECONDS = 300
+
+# Model families that accept OpenAI's native JSON-schema response format
+STRUCTURED_OUTPUT_MODEL_PREFIXES = ("gpt-4o", "gpt-4.1", "gpt-5", "o1", "o3", "o4")
+
+# Letter validation patterns
+_ARABIC_RE = re.compile(r'[\u0600-\u06FF]')
+_REQUIRED_ELEMENTS = (
+    "بسم الله الرحمن الرحيم",
+    "السلام عليكم"
+)
+_REQUIRED_RE = re.compile("|".join(map(re.escape, _REQUIRED_ELEMENTS)))
+
+# Fallbacks for optional prompt inputs
+_DEFAULT_REFERENCE_CONTEXT = "استخدم تنسيق الخطاب الرسمي العربي القياسي"
+_DEFAULT_WRITING_INSTRUCTIONS = "اكتب خطاباً رسمياً واضحاً ومهنياً"
+
+# Static prompt sections shared by the single-letter and packed (batch) prompts
+_CONTACT_INFO_RULES = """# تعليمات خاصة حول معلومات التواصل:
+- عند الحاجة لإدراج معلومات التواصل، يجب أن تُدمج في سياق الخطاب بصياغة رسمية مناسبة، مثل:
+  • "وللاستفسارات أو التنسيق، يُرجى التواصل مع الشخص المسؤول على الرقم: [رقم الجوال]، أو عبر البريد الإلكتروني: [البريد الإلكتروني]"
+  • أو: "مدير العمليات في \"نت زيرو\"، هاتف: [رقم الجوال] ، بريد إلكتروني: [البريد الإلكتروني]"
+- يُمنع سرد معلومات التواصل بشكل منفصل أو جاف (مثل: "الاسم: ...، البريد الإلكتروني: ...، الجوال: ...")، ويجب دائماً دمجها ضمن جملة رسمية أو فقرة ختامية مناسبة.
+
+"""
+
+# Rule 9 of _STRICT_RULES: the schema is only spelled out in the prompt on the parser path
+_OUTPUT_FORMAT_RULE = "✅ **الإخراج النهائي يجب أن يكون بتنسيق JSON صالح 100% ودون أي نص خارجي أو تعليق، ويطابق المخطط التالي بدقة.**"
+_STRUCTURED_OUTPUT_FORMAT_RULE = "✅ **الإخراج النهائي يجب أن يكون بتنسيق JSON صالح 100% ودون أي نص خارجي أو تعليق.**"
+
+_STRICT_RULES = """# تعليمات صارمة يجب اتباعها
+1. ✅ **يجب أن يستند الخطاب فقط إلى "المحتوى الأساسي".** لا تستخدم أي معلومة أو فكرة من خارج هذا القسم.
+2. ✅ **النموذج المرجعي يستخدم فقط لتقليد الشكل والتنسيق (مقدمة/تنسيق الفقرات/الخاتمة)**، ويُمنع تمامًا الاقتباس أو إعادة صياغة أي جملة، أو أخذ أسماء أو أرقام أو تواريخ منه.
+3. ⛔ **لا تضف أي عبارات تهنئة أو مناسبات أو ألقاب بروتوكولية (مثل: "سلمه الله"، "حفظه الله") أو دعاء أو شكر إلا إذا ذُكرت صراحة في "المحتوى الأساسي".** إذا لم يُذكر عيد أو مناسبة فلا تبدأ الخطاب بأي تهنئة.
+4. 🧠 **ركّز على إنشاء خطاب جديد بالكامل حول "{user_prompt}" فقط، ولا تقم بتلخيص أو تعديل النموذج المرجعي أو استعارة أي من عناصره النصية.**
+5. 📝 **الخطاب يجب أن يكون مفصلًا واحترافيًا، باللغة العربية الفصحى، مع التزام كامل بالمقدمة، عرض الغرض والمناسبة، شرح واضح لأي فعالية أو طلب، وإنهاء الخطاب بصيغة رسمية محترمة (حسب المعطيات).**
+6. ⛔ **لا تدخل أي معلومات تواصل (أسماء، أرقام، بريد إلكتروني، توقيعات) إلا من "معلومات المُرسِل"، ولا تفترض أو تستنتج أو تنقل أي بيانات من النموذج المرجعي.**
+7. ✅ **ابدأ الخطاب بهذا الترتيب إلزاميًا:** "بسم الله الرحمن الرحيم"، ثم اسم الجهة المخاطبة (حسب بيانات الخطاب أو السياق)، ثم التحية الرسمية ("السلام عليكم ورحمة الله وبركاته")، ثم محتوى الخطاب.
+8. ✅ **في إخراج JSON، يجب أن يكون الحقل "Title" عنوانًا مختصرًا دقيقًا للخطاب مستمدًا فقط من "المحتوى الأساسي"، بدون أي عبارات ترحيب أو تهنئة.**
+9. {output_format_rule}
+10. ⛔ **لا تكرر المعلومات داخل الخطاب بأكثر من صياغة أو تكرار الطلبات أو العبارات في أكثر من فقرة.**
+11. ✅ **في حال وجود أي تعارض بين التعليمات، الأولوية دائمًا للمحتوى الأساسي.**
+12. ⛔ **لا تضف أو تستنتج أي فقرات أو جمل غير منصوص عليها بوضوح في التعليمات أو "المحتوى الأساسي".**
+13. ✅ **في الخاتمة: اكتب كلمات ختامية مهذبة فقط، ولا تدمج موضوعات جديدة أو تبدأ بطلبات إضافية.**
+14. ⛔ **تجنب استخدام العبارات التالية أو ما يشابهها في جميع الخطابات: "نتشرف بمخاطبتكم"، "يطيب لنا"، أو أي تعبير مبالغ فيه في التبجيل أو التكلف. استخدم عبارات مباشرة مثل: "نتقدم إليكم بجزيل الشكر" أو "نثمن جهودكم" بحسب السياق.**
+15. ✅ **إذا كان الخطاب تهنئة أو مناسبة، اجعل عبارة التهنئة الختامية (مثل "كل عام وأنتم بخير") في سطر مستقل، واحذف أي عبارات رسمية ختامية (مثل: "وتفضلوا بقبول فائق الاحترام والتقدير") من خطابات التهنئة.**
+16. ✅ **في الخطابات الرسمية (غير التهنئة)، عند كتابة عبارة الخاتمة (مثل: "وتفضلوا بقبول فائق الاحترام والتقدير")، أضف ثلاث فواصل (،،،) بعد العبارة.**
+17. ✅ **قسّم الطلبات والتوصيات إلى فقرات واضحة، وتجنب تكرار نفس الطلب أو التوصية في أكثر من فقرة. حسن الانتقال بين الفقرات بحيث يكون الخطاب متسقاً وسلساً.**
+18. ⛔ **يُمنع منعًا باتًا على المساعد إضافة أو افتراض أو استنتاج أي تواريخ أو مواعيد أو أيام أحداث (مثل: "في اليوم الموافق ...") إلا إذا وردت صراحة في "المحتوى الأساسي" المُدخل من المستخدم.**
+
+"""
+
 @dataclass
 class LetterGenerationContext:
     """Context for letter generation with all necessary information."""
@@ -44,6 +107,7 @@ class LetterGenerationContext:
     previous_letter_id: Optional[str] = None
     letter_id: Optional[str] = None
     session_id: Optional[str] = None
+    cache_bypass: bool = False
     
     def __post_init__(self):
         """Validate and process context data."""
@@ -57,6 +121,57 @@ class LetterGenerationContext:
         self.user_prompt = self.user_prompt.strip()
         if self.recipient:
             self.recipient = self.recipient.strip()
+    
+    def cache_key(self, prompt_inputs: str = "", include_prompt: bool = True) -> str:
+        """
+        Fingerprint of the request content, ignoring per-request identifiers.
+        
+        prompt_inputs carries the prompt text resolved outside the context (date,
+        memory instructions, intro text), which changes the letter just as much.
+        """
+        data = asdict(self)
+        for field_name in ("letter_id", "session_id", "cache_bypass"):
+            data.pop(field_name)
+        if not include_prompt:
+            data.pop("user_prompt")
+        data["prompt_inputs"] = prompt_inputs
+        payload = json.dumps(data, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+@lru_cache(maxsize=256)
+def _cached_context_string(
+    recipient_key: Tuple[Optional[str], Optional[str], Optional[str], bool],
+    intro_text: Optional[str]
+) -> str:
+    """Build the additional-context prompt section; repeated recipients hit the cache."""
+    recipient, recipient_title, recipient_job_title, is_first_contact = recipient_key
+    context_parts = []
+
+    if recipient:
+        context_parts.append(f"المرسل إليه: {recipient}")
+    if recipient_title:
+        context_parts.append(f"""تعليمات هامة حول اللقب والدعاء للمرسل إليه:
+- اللقب المرسل إليه الخطاب يجب وضعه قبل الاسم: {recipient_title}
+- يجب وضع الدعاء المناسب للقب المرسل إليه في أقصى اليسار على نفس السطر الذي يظهر فيه اسمه
+- صيغة الدعاء المناسب حسب اللقب:
+  • أصحاب السمو: يُستخدم معهم دعاء "حفظه الله"
+  • السادة: يُستخدم معهم دعاء "سلمهم الله"
+  • أصحاب المعالي، معالي، سعادة، وغيرهم من الألقاب المشابهة: يُستخدم معهم دعاء "سلمه الله"
+- مثال: سعادة الأستاذ عبدالله محمد                سلمه الله""")
+    if recipient_job_title:
+        context_parts.append(f"""تعليمات هامة حول المخاطبة:
+- يجب مراعاة التذكير والتأنيث في الألقاب والوظائف حسب جنس المرسل إليه
+- للإناث: استخدم صيغة التأنيث (مثل: مهندسة، دكتورة، أستاذة، مديرة)
+- للذكور: استخدم صيغة التذكير (مثل: مهندس، دكتور، أستاذ، مدير)
+- أمثلة توضيحية: (مهندسة فاطمة وليس مهندس فاطمة) (الدكتورة نورة وليس الدكتور نورة)
+- وظيفة المرسل إليه الخطاب: {recipient_job_title}""")
+
+    if is_first_contact:
+        context_parts.append(intro_text)
+    else:
+        context_parts.append("توجد مراسلات سابقة مع الجهة المذكورة")
+    
+    return "\n".join(context_parts) if context_parts else "لا توجد سياقات إضافية."
 
 class ArabicLetterGenerationService:
     """
@@ -68,8 +183,25 @@ class ArabicLetterGenerationService:
         self.config = get_config()
         self._validate_configuration()
         
-        self.parser = JsonOutputParser(pydantic_object=LetterOutput)
+        self.parser = PydanticOutputParser(pydantic_object=LetterOutput)
+        self.stream_parser = JsonOutputParser(pydantic_object=LetterOutput)
+        self.batch_parser = PydanticOutputParser(pydantic_object=LetterBatchOutput)
+        self.http_client = self._build_http_client()
+        self.llm = self._build_llm()
+        self.use_structured_output = self._supports_structured_output()
         self.chain = self._build_chain()
+        self.stream_chain = self._build_stream_chain()
+        self.batch_chain = self._build_batch_chain()
+        
+        # Per-category memory instructions, rebuilt after the TTL expires
+        self._memory_instructions_cache = MemoryCache(ttl_seconds=MEMORY_INSTRUCTIONS_TTL_SECONDS)
+        self._intro_text_cache = MemoryCache(ttl_seconds=INTRO_TEXT_TTL_SECONDS)
+        self._warm_memory_service()
+        
+        # Exact-match cache of previously generated letters (opt-in)
+        self.response_cache = get_response_cache() if self.config.ai.response_cache else None
+        # Near-duplicate prompt cache (opt-in: costs one embedding call per miss)
+        self.semantic_cache = get_semantic_cache() if self.config.ai.semantic_cache else None
         
         logger.info("Arabic Letter Generation Service initialized")
     
@@ -80,17 +212,39 @@ class ArabicLetterGenerationService:
         
         logger.info(f"Using AI model: {self.config.ai.model_name}")
     
+    def _supports_structured_output(self) -> bool:
+        """Check whether the configured model can return schema-constrained JSON natively."""
+        return (
+            self.config.ai.structured_output
+            and self.config.ai.model_name.startswith(STRUCTURED_OUTPUT_MODEL_PREFIXES)
+        )
+    
+    def _warm_memory_service(self):
+        """Create the memory service up front so the first letter does not pay for it."""
+        try:
+            get_memory_service()
+        except Exception as e:
+            logger.warning(f"Failed to warm memory service: {e}")
+    
     def _get_memory_instructions(self, context: LetterGenerationContext) -> str:
         """Get formatted memory instructions for the prompt."""
+        cache_key = context.category or ""
         try:
-            from .memory_service import get_memory_service
             memory_service = get_memory_service()
-            instructions = memory_service.format_instructions_for_prompt(
+            cached = self._memory_instructions_cache.get(cache_key)
+            if cached is not None:
+                instructions, instruction_ids = cached
+                # Only the formatting is cached; every prompt still counts as a use
+                memory_service.record_prompt_use(instruction_ids)
+                return instructions
+            
+            instructions, instruction_ids = memory_service.format_instructions_with_ids(
                 category=context.category,
                 session_id=context.session_id
             )
+            self._memory_instructions_cache.set(cache_key, (instructions, instruction_ids))
             logger.info(f"Retrieved memory instructions for category='{context.category}', session_id='{context.session_id}': {len(instructions)} chars")
-            logger.debug(f"Memory instructions content: {instructions}")
+            logger.debug("Memory instructions content: %s", instructions)
             return instructions
         except Exception as e:
             logger.warning(f"Failed to get memory instructions: {e}")
@@ -110,13 +264,7 @@ class ArabicLetterGenerationService:
 3. **سياق إضافي للخطاب الجديد:** {additional_context}
 4. **معلومات المُرسِل (يجب دمجها في الخطاب بصياغة رسمية مناسبة):** {member_info}
 
-# تعليمات خاصة حول معلومات التواصل:
-- عند الحاجة لإدراج معلومات التواصل، يجب أن تُدمج في سياق الخطاب بصياغة رسمية مناسبة، مثل:
-  • "وللاستفسارات أو التنسيق، يُرجى التواصل مع الشخص المسؤول على الرقم: [رقم الجوال]، أو عبر البريد الإلكتروني: [البريد الإلكتروني]"
-  • أو: "مدير العمليات في \"نت زيرو\"، هاتف: [رقم الجوال] ، بريد إلكتروني: [البريد الإلكتروني]"
-- يُمنع سرد معلومات التواصل بشكل منفصل أو جاف (مثل: "الاسم: ...، البريد الإلكتروني: ...، الجوال: ...")، ويجب دائماً دمجها ضمن جملة رسمية أو فقرة ختامية مناسبة.
-
-5. **تعليمات الكتابة:** {writing_instructions}
+""" + _CONTACT_INFO_RULES + """5. **تعليمات الكتابة:** {writing_instructions}
 6. **بيانات الخطاب الجديد:**
    - معرف الخطاب: {letter_id}
    - تاريخ اليوم: {current_date}
@@ -124,89 +272,132 @@ class ArabicLetterGenerationService:
 
 {memory_instructions}
 
-# تعليمات صارمة يجب اتباعها
-1. ✅ **يجب أن يستند الخطاب فقط إلى "المحتوى الأساسي".** لا تستخدم أي معلومة أو فكرة من خارج هذا القسم.
-2. ✅ **النموذج المرجعي يستخدم فقط لتقليد الشكل والتنسيق (مقدمة/تنسيق الفقرات/الخاتمة)**، ويُمنع تمامًا الاقتباس أو إعادة صياغة أي جملة، أو أخذ أسماء أو أرقام أو تواريخ منه.
-3. ⛔ **لا تضف أي عبارات تهنئة أو مناسبات أو ألقاب بروتوكولية (مثل: "سلمه الله"، "حفظه الله") أو دعاء أو شكر إلا إذا ذُكرت صراحة في "المحتوى الأساسي".** إذا لم يُذكر عيد أو مناسبة فلا تبدأ الخطاب بأي تهنئة.
-4. 🧠 **ركّز على إنشاء خطاب جديد بالكامل حول "{user_prompt}" فقط، ولا تقم بتلخيص أو تعديل النموذج المرجعي أو استعارة أي من عناصره النصية.**
-5. 📝 **الخطاب يجب أن يكون مفصلًا واحترافيًا، باللغة العربية الفصحى، مع التزام كامل بالمقدمة، عرض الغرض والمناسبة، شرح واضح لأي فعالية أو طلب، وإنهاء الخطاب بصيغة رسمية محترمة (حسب المعطيات).**
-6. ⛔ **لا تدخل أي معلومات تواصل (أسماء، أرقام، بريد إلكتروني، توقيعات) إلا من "معلومات المُرسِل"، ولا تفترض أو تستنتج أو تنقل أي بيانات من النموذج المرجعي.**
-7. ✅ **ابدأ الخطاب بهذا الترتيب إلزاميًا:** "بسم الله الرحمن الرحيم"، ثم اسم الجهة المخاطبة (حسب بيانات الخطاب أو السياق)، ثم التحية الرسمية ("السلام عليكم ورحمة الله وبركاته")، ثم محتوى الخطاب.
-8. ✅ **في إخراج JSON، يجب أن يكون الحقل "Title" عنوانًا مختصرًا دقيقًا للخطاب مستمدًا فقط من "المحتوى الأساسي"، بدون أي عبارات ترحيب أو تهنئة.**
-9. ✅ **الإخراج النهائي يجب أن يكون بتنسيق JSON صالح 100% ودون أي نص خارجي أو تعليق، ويطابق المخطط التالي بدقة.**
-10. ⛔ **لا تكرر المعلومات داخل الخطاب بأكثر من صياغة أو تكرار الطلبات أو العبارات في أكثر من فقرة.**
-11. ✅ **في حال وجود أي تعارض بين التعليمات، الأولوية دائمًا للمحتوى الأساسي.**
-12. ⛔ **لا تضف أو تستنتج أي فقرات أو جمل غير منصوص عليها بوضوح في التعليمات أو "المحتوى الأساسي".**
-13. ✅ **في الخاتمة: اكتب كلمات ختامية مهذبة فقط، ولا تدمج موضوعات جديدة أو تبدأ بطلبات إضافية.**
-14. ⛔ **تجنب استخدام العبارات التالية أو ما يشابهها في جميع الخطابات: "نتشرف بمخاطبتكم"، "يطيب لنا"، أو أي تعبير مبالغ فيه في التبجيل أو التكلف. استخدم عبارات مباشرة مثل: "نتقدم إليكم بجزيل الشكر" أو "نثمن جهودكم" بحسب السياق.**
-15. ✅ **إذا كان الخطاب تهنئة أو مناسبة، اجعل عبارة التهنئة الختامية (مثل "كل عام وأنتم بخير") في سطر مستقل، واحذف أي عبارات رسمية ختامية (مثل: "وتفضلوا بقبول فائق الاحترام والتقدير") من خطابات التهنئة.**
-16. ✅ **في الخطابات الرسمية (غير التهنئة)، عند كتابة عبارة الخاتمة (مثل: "وتفضلوا بقبول فائق الاحترام والتقدير")، أضف ثلاث فواصل (،،،) بعد العبارة.**
-17. ✅ **قسّم الطلبات والتوصيات إلى فقرات واضحة، وتجنب تكرار نفس الطلب أو التوصية في أكثر من فقرة. حسن الانتقال بين الفقرات بحيث يكون الخطاب متسقاً وسلساً.**
-18. ⛔ **يُمنع منعًا باتًا على المساعد إضافة أو افتراض أو استنتاج أي تواريخ أو مواعيد أو أيام أحداث (مثل: "في اليوم الموافق ...") إلا إذا وردت صراحة في "المحتوى الأساسي" المُدخل من المستخدم.**
+""" + _STRICT_RULES + """{format_instructions}
+"""
+        return PromptTemplate.from_template(
+            template,
+            partial_variables={
+                # The schema is enforced by the API in structured mode, so the
+                # JSON-schema example block would only cost prompt tokens
+                "format_instructions": "" if self.use_structured_output else self.parser.get_format_instructions(),
+                "output_format_rule": _STRUCTURED_OUTPUT_FORMAT_RULE if self.use_structured_output else _OUTPUT_FORMAT_RULE,
+                "current_date": get_current_arabic_date
+            }
+        )
+    
+    def _get_batch_prompt_template(self) -> PromptTemplate:
+        """
+        Creates the prompt template for packing several letter requests into one call.
+        The shared instruction blocks are sent once per batch instead of once per letter.
+        """
+        template = """
+أنت كاتب خطابات محترف ومساعد ذكي لشركة `نت زيرو`. مهمتك هي كتابة عدة خطابات رسمية مستقلة باللغة العربية، خطاب واحد لكل طلب من طلبات الدفعة التالية، مع الالتزام الصارم بجميع التعليمات المحددة أدناه في كل خطاب على حدة.
+
+# طلبات الدفعة
+{batch_requests}
+
+""" + _CONTACT_INFO_RULES + """# بيانات مشتركة
+- تاريخ اليوم: {current_date}
+
+{memory_instructions}
+
+""" + _STRICT_RULES + """# تعليمات إخراج الدفعة
+- أعد مصفوفة JSON واحدة تحتوي على خطاب واحد لكل طلب وبنفس ترتيب الطلبات.
+- يجب أن يطابق الحقل "ID" في كل عنصر معرف الخطاب المذكور في الطلب المقابل.
+- لا تدمج محتوى أي طلب في خطاب طلب آخر.
 
 {format_instructions}
 """
         return PromptTemplate.from_template(
             template,
-            partial_variables={"format_instructions": self.parser.get_format_instructions()}
+            partial_variables={
+                "user_prompt": "المحتوى الأساسي الخاص بكل طلب",
+                "format_instructions": self.batch_parser.get_format_instructions(),
+                "output_format_rule": _OUTPUT_FORMAT_RULE,
+                "current_date": get_current_arabic_date
+            }
         )
     
-    def _build_chain(self) -> Runnable:
-        """Constructs the full LCEL chain: prompt -> llm -> parser."""
-        prompt = self._get_prompt_template()
-        llm = ChatOpenAI(
+    def _build_http_client(self) -> httpx.Client:
+        """Create a pooled HTTP/2 client so connections to the API are kept alive across letters."""
+        return httpx.Client(
+            limits=httpx.Limits(
+                max_keepalive_connections=self.config.ai.max_keepalive_connections,
+                max_connections=self.config.ai.max_connections
+            ),
+            timeout=self.config.ai.timeout,
+            http2=True
+        )
+    
+    def _build_llm(self) -> ChatOpenAI:
+        """Create the chat model shared by the single-letter and batch chains."""
+        return ChatOpenAI(
             model=self.config.ai.model_name,
             temperature=self.config.ai.temperature,
             openai_api_key=self.config.openai_api_key,
             timeout=self.config.ai.timeout,
-            max_retries=self.config.ai.max_retries
+            max_retries=self.config.ai.max_retries,
+            http_client=self.http_client
         )
-        return prompt | llm | self.parser
+    
+    def _build_chain(self) -> Runnable:
+        """Constructs the full LCEL chain: prompt -> llm -> parser (or prompt -> structured llm)."""
+        prompt = self._get_prompt_template()
+        if self.use_structured_output:
+            structured_llm = self.llm.with_structured_output(
+                LetterOutput,
+                method="json_schema",
+                strict=True
+            )
+            return prompt | structured_llm
+        return prompt | self.llm | self.parser
+    
+    def _build_stream_chain(self) -> Runnable:
+        """Constructs the streaming chain, which yields partial dicts while the model types."""
+        prompt = self._get_prompt_template()
+        if self.use_structured_output:
+            # A dict schema makes the structured model stream partial dicts instead of one final model
+            structured_llm = self.llm.with_structured_output(
+                LetterOutput.model_json_schema(),
+                method="json_schema",
+                strict=True
+            )
+            return prompt | structured_llm
+        return prompt | self.llm | self.stream_parser
+    
+    def _build_batch_chain(self) -> Runnable:
+        """Constructs the packed LCEL chain: batch prompt -> llm -> array parser."""
+        prompt = self._get_batch_prompt_template()
+        return prompt | self.llm | self.batch_parser
+    
+    def _get_intro_text(self) -> str:
+        """Get the first-contact intro text from the Intro worksheet, cached for a short TTL."""
+        cached = self._intro_text_cache.get("intro")
+        if cached is not None:
+            return cached
+        
+        try:
+            from .google_services import get_sheets_service
+            sheets_service = get_sheets_service()
+            intro_text = sheets_service.get_intro_text()
+
+            if intro_text:
+                logger.debug("Intro text loaded from Intro worksheet")
+                self._intro_text_cache.set("intro", intro_text)
+                return intro_text
+            
+            logger.warning("No intro text found in Intro worksheet, using fallback text")
+        except Exception as e:
+            logger.error(f"Failed to fetch intro text from sheet: {e}, using fallback text")
+        return "هذا هو الاتصال الأول مع المستلم."
     
     def _build_context_string(self, context: LetterGenerationContext) -> str:
         """Build additional context string from generation context."""
-        context_parts = []
-
-        if context.recipient:
-            context_parts.append(f"المرسل إليه: {context.recipient}")
-        if context.recipient_title:
-            context_parts.append(f"""تعليمات هامة حول اللقب والدعاء للمرسل إليه:
-- اللقب المرسل إليه الخطاب يجب وضعه قبل الاسم: {context.recipient_title}
-- يجب وضع الدعاء المناسب للقب المرسل إليه في أقصى اليسار على نفس السطر الذي يظهر فيه اسمه
-- صيغة الدعاء المناسب حسب اللقب:
-  • أصحاب السمو: يُستخدم معهم دعاء "حفظه الله"
-  • السادة: يُستخدم معهم دعاء "سلمهم الله"
-  • أصحاب المعالي، معالي، سعادة، وغيرهم من الألقاب المشابهة: يُستخدم معهم دعاء "سلمه الله"
-- مثال: سعادة الأستاذ عبدالله محمد                سلمه الله""")
-        if context.recipient_job_title:
-            context_parts.append(f"""تعليمات هامة حول المخاطبة:
-- يجب مراعاة التذكير والتأنيث في الألقاب والوظائف حسب جنس المرسل إليه
-- للإناث: استخدم صيغة التأنيث (مثل: مهندسة، دكتورة، أستاذة، مديرة)
-- للذكور: استخدم صيغة التذكير (مثل: مهندس، دكتور، أستاذ، مدير)
-- أمثلة توضيحية: (مهندسة فاطمة وليس مهندس فاطمة) (الدكتورة نورة وليس الدكتور نورة)
-- وظيفة المرسل إليه الخطاب: {context.recipient_job_title}""")
-        # if context.organization_name:
-        #     context_parts.append(f"اسم المؤسسة: {context.organization_name}")
-
-        if context.is_first_contact:
-            try:
-                from .google_services import get_sheets_service
-                sheets_service = get_sheets_service()
-                intro_text = sheets_service.get_intro_text()
-
-                if intro_text:
-                    context_parts.append(intro_text)
-                    logger.debug("Intro text loaded from Intro worksheet")
-                else:
-                    logger.warning("No intro text found in Intro worksheet, using fallback text")
-                    context_parts.append("هذا هو الاتصال الأول مع المستلم.")
-            except Exception as e:
-                logger.error(f"Failed to fetch intro text from sheet: {e}, using fallback text")
-                context_parts.append("هذا هو الاتصال الأول مع المستلم.")
-        else:
-            context_parts.append("توجد مراسلات سابقة مع الجهة المذكورة")
-        
-        return "\n".join(context_parts) if context_parts else "لا توجد سياقات إضافية."
+        intro_text = self._get_intro_text() if context.is_first_contact else None
+        return _cached_context_string(
+            (context.recipient, context.recipient_title, context.recipient_job_title, context.is_first_contact),
+            intro_text
+        )
     
     def _build_previous_letter_info(self, context: LetterGenerationContext) -> str:
         """Build previous letter information string."""
@@ -217,8 +408,54 @@ class ArabicLetterGenerationService:
 - تعليمة: استخدم هذه المعلومات للسياق وتجنب التكرار، ولكن لا تقتبس منها مباشرة."""
         return ""
     
-    @handle_ai_service_errors
-    @measure_performance
+    def _build_input_data(self, context: LetterGenerationContext) -> Dict[str, Any]:
+        """Build the prompt input variables for the chain from the generation context."""
+        return {
+            "user_prompt": context.user_prompt,
+            "reference_context": context.reference_letter or _DEFAULT_REFERENCE_CONTEXT,
+            "additional_context": self._build_context_string(context),
+            "writing_instructions": context.writing_instructions or _DEFAULT_WRITING_INSTRUCTIONS,
+            "member_info": context.member_info,
+            "letter_id": context.letter_id,
+            "previous_letter_info": self._build_previous_letter_info(context),
+            "memory_instructions": self._get_memory_instructions(context)
+        }
+    
+    def _build_batch_input_data(self, contexts: List[LetterGenerationContext]) -> Dict[str, Any]:
+        """Build the prompt input variables for a packed batch of generation contexts."""
+        requests = []
+        for index, context in enumerate(contexts, 1):
+            request = f"""## الطلب {index}
+1. **المحتوى الأساسي (المطلوب كتابته):** {context.user_prompt}
+2. **نموذج للهيكل والأسلوب (للاسترشاد بالشكل فقط):** {context.reference_letter or _DEFAULT_REFERENCE_CONTEXT}
+3. **سياق إضافي للخطاب الجديد:** {self._build_context_string(context)}
+4. **معلومات المُرسِل (يجب دمجها في الخطاب بصياغة رسمية مناسبة):** {context.member_info}
+5. **تعليمات الكتابة:** {context.writing_instructions or _DEFAULT_WRITING_INSTRUCTIONS}
+6. **معرف الخطاب:** {context.letter_id}"""
+            # Only number the previous-letter item when there is one, so no empty item is sent
+            previous_letter_info = self._build_previous_letter_info(context)
+            if previous_letter_info:
+                request += f"\n7. {previous_letter_info}"
+            requests.append(request)
+        
+        return {
+            "batch_requests": "\n\n".join(requests),
+            "memory_instructions": self._get_memory_instructions(contexts[0])
+        }
+    
+    def _to_letter_output(self, result: Any) -> LetterOutput:
+        """Check a chain result (already validated by the parser) and return it as a LetterOutput."""
+        if not isinstance(result, LetterOutput):
+            logger.error(f"Unexpected result type: {type(result)}, value: {result}")
+            raise AIServiceError(f"Invalid response type: {type(result)}")
+        
+        # Additional validation
+        if not result.Letter or len(result.Letter.strip()) < 50:
+            raise AIServiceError("Generated letter is too short or empty")
+        
+        return result
+    
+    @instrument("letter_generation")
     def generate_letter(self, context: LetterGenerationContext) -> LetterOutput:
         """
         Generate a professional Arabic letter using the provided context.
@@ -233,55 +470,196 @@ class ArabicLetterGenerationService:
             AIServiceError: If letter generation fails
             ValidationError: If context validation fails
         """
-        with ErrorContext("letter_generation", {"letter_id": context.letter_id, "category": context.category}):
-            # Prepare input data for the chain
-            input_data = {
-                "user_prompt": context.user_prompt,
-                "reference_context": context.reference_letter or "استخدم تنسيق الخطاب الرسمي العربي القياسي",
-                "additional_context": self._build_context_string(context),
-                "writing_instructions": context.writing_instructions or "اكتب خطاباً رسمياً واضحاً ومهنياً",
-                "member_info": context.member_info,
-                "letter_id": context.letter_id,
-                "current_date": get_current_arabic_date(),
-                "previous_letter_info": self._build_previous_letter_info(context),
-                "memory_instructions": self._get_memory_instructions(context)
-            }
+        tag_operation(letter_id=context.letter_id, category=context.category)
+        
+        # Prepare input data for the chain
+        input_data = self._build_input_data(context)
+        
+        use_cache = not context.cache_bypass and (self.response_cache is not None or self.semantic_cache is not None)
+        # The date, memory instructions and intro text (part of the additional context) are
+        # resolved outside the context but change the letter, so they are part of the key
+        prompt_inputs = "\n".join((
+            get_current_arabic_date(),
+            input_data["memory_instructions"],
+            input_data["additional_context"]
+        )) if use_cache else ""
+        
+        cache_key = context.cache_key(prompt_inputs) if use_cache and self.response_cache is not None else None
+        if cache_key:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Returning cached letter for ID: {context.letter_id}")
+                return cached.model_copy(update={"ID": context.letter_id})
+        
+        semantic_key = prompt_embedding = None
+        if use_cache and self.semantic_cache is not None:
+            try:
+                semantic_key = context.cache_key(prompt_inputs, include_prompt=False)
+                prompt_embedding = self.semantic_cache.embed(context.user_prompt)
+                cached = self.semantic_cache.match(semantic_key, prompt_embedding)
+                if cached is not None:
+                    logger.info(f"Returning semantically cached letter for ID: {context.letter_id}")
+                    return cached.model_copy(update={"ID": context.letter_id})
+            except Exception as e:
+                logger.warning(f"Semantic cache lookup failed: {e}")
+                semantic_key = prompt_embedding = None
+        
+        logger.info(f"Generating letter with ID: {context.letter_id}")
+        logger.debug("Input data prepared for letter generation: %s", input_data.keys())
+        logger.debug("Memory instructions being used: '%s'", input_data['memory_instructions'])
+        
+        try:
+            # Invoke the chain
+            result = self._to_letter_output(self.chain.invoke(input_data))
+            
+            if cache_key:
+                self.response_cache.set(cache_key, result)
+            if prompt_embedding is not None:
+                self.semantic_cache.add(semantic_key, prompt_embedding, result)
+            
+            logger.info(f"Letter generated successfully: {result.ID}")
+            return result
+            
+        except Exception as e:
+            # @instrument logs the failure once, tagged with the letter ID
+            raise AIServiceError(f"Failed to generate letter: {str(e)}")
+    
+    def generate_letters_packed(
+        self,
+        contexts: List[LetterGenerationContext],
+        batch_size: int = 4
+    ) -> List[LetterOutput]:
+        """
+        Generate several independent letters, packing up to batch_size requests per AI call.
+        
+        The shared instruction blocks are sent once per call instead of once per letter,
+        so only contexts with the same category and session are packed together.
+        If the model returns a malformed array for a batch, that batch is retried as
+        individual requests through the single-letter chain.
+        
+        Args:
+            contexts: Generation contexts, typically for letters in the same category
+            batch_size: Maximum number of requests packed into a single call
             
-            logger.info(f"Generating letter with ID: {context.letter_id}")
-            logger.debug(f"Input data prepared for letter generation: {list(input_data.keys())}")
-            logger.debug(f"Memory instructions being used: '{input_data['memory_instructions']}'")
+        Returns:
+            Generated letters in the same order as the given contexts
             
+        Raises:
+            AIServiceError: If letter generation fails
+            ValidationError: If batch_size is not positive
+        """
+        # Checked outside @instrument, which would convert it into an AIServiceError
+        if batch_size < 1:
+            raise ValidationError("Batch size must be at least 1")
+        
+        return self._generate_letters_packed(contexts, batch_size)
+    
+    @instrument("packed_letter_generation")
+    def _generate_letters_packed(
+        self,
+        contexts: List[LetterGenerationContext],
+        batch_size: int
+    ) -> List[LetterOutput]:
+        """Group contexts by the memory instructions they share and generate each group in packed chunks."""
+        groups: Dict[Tuple[str, Optional[str]], List[int]] = {}
+        for index, context in enumerate(contexts):
+            groups.setdefault((context.category, context.session_id), []).append(index)
+        
+        letters: List[Optional[LetterOutput]] = [None] * len(contexts)
+        for indexes in groups.values():
+            for start in range(0, len(indexes), batch_size):
+                chunk = indexes[start:start + batch_size]
+                tag_operation(batch_start=chunk[0], batch_size=len(chunk))
+                chunk_letters = self._generate_packed_chunk([contexts[index] for index in chunk])
+                for index, letter in zip(chunk, chunk_letters):
+                    letters[index] = letter
+        
+        logger.info(f"Generated {len(letters)} letters in {len(groups)} groups of packed batches of up to {batch_size}")
+        return letters
+    
+    def _generate_packed_chunk(self, contexts: List[LetterGenerationContext]) -> List[LetterOutput]:
+        """Generate one packed batch, falling back to one call per letter on a malformed response."""
+        if len(contexts) > 1:
             try:
-                # Invoke the chain
-                result = self.chain.invoke(input_data)
-                
-                # Handle different result types from LangChain
-                if isinstance(result, dict):
-                    # JsonOutputParser returned a dictionary, convert to LetterOutput
-                    try:
-                        result = LetterOutput(**result)
-                    except Exception as e:
-                        logger.error(f"Failed to convert dict result to LetterOutput: {e}")
-                        logger.error(f"Result data: {result}")
-                        raise AIServiceError(f"Invalid result format from AI service: {str(e)}")
-                elif isinstance(result, LetterOutput):
-                    # Already a LetterOutput object
-                    pass
-                else:
-                    # Unexpected type
-                    logger.error(f"Unexpected result type: {type(result)}, value: {result}")
-                    raise AIServiceError(f"Invalid response type: {type(result)}")
-                
-                # Additional validation
-                if not result.Letter or len(result.Letter.strip()) < 50:
-                    raise AIServiceError("Generated letter is too short or empty")
-                
-                logger.info(f"Letter generated successfully: {result.ID}")
-                return result
+                batch = self.batch_chain.invoke(self._build_batch_input_data(contexts))
+                if len(batch.root) != len(contexts):
+                    raise AIServiceError(f"Expected {len(contexts)} letters, got {len(batch.root)}")
                 
+                # Pin each letter to the ID of the request in the same position
+                return [
+                    self._to_letter_output(letter.model_copy(update={"ID": context.letter_id}))
+                    for letter, context in zip(batch.root, contexts)
+                ]
+            except Exception as e:
+                logger.warning(f"Packed generation failed for {len(contexts)} letters, retrying individually: {e}")
+        
+        # A failing letter must not discard the rest of the chunk, so failures are collected
+        # per item and only those letters are retried
+        results = self.chain.batch(
+            [self._build_input_data(context) for context in contexts],
+            return_exceptions=True
+        )
+        letters: List[LetterOutput] = []
+        failed_ids: List[str] = []
+        for result, context in zip(results, contexts):
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                letters.append(self._to_letter_output(result))
             except Exception as e:
-                logger.error(f"Letter generation failed for ID {context.letter_id}: {e}")
-                raise AIServiceError(f"Failed to generate letter: {str(e)}")
+                logger.warning(f"Letter {context.letter_id} failed in packed fallback, retrying once: {e}")
+                try:
+                    letters.append(self._to_letter_output(self.chain.invoke(self._build_input_data(context))))
+                except Exception as retry_error:
+                    logger.warning(f"Retry failed for letter {context.letter_id}: {retry_error}")
+                    failed_ids.append(context.letter_id)
+        
+        if failed_ids:
+            raise AIServiceError(f"Failed to generate {len(failed_ids)} of {len(contexts)} letters: {', '.join(failed_ids)}")
+        return letters
+    
+    async def astream_letter(self, context: LetterGenerationContext) -> AsyncIterator[Union[str, LetterOutput]]:
+        """
+        Stream the letter body incrementally as the model produces it.
+        
+        The streaming chain yields partial dictionaries while
+        the model is still typing, so each time the "Letter" field grows only the
+        newly generated text is emitted. Once the model is done, the last partial
+        dictionary is validated into the complete LetterOutput, which is yielded last.
+        
+        Args:
+            context: Letter generation context with all necessary information
+            
+        Yields:
+            Successive fragments of the generated letter body, then the LetterOutput
+            
+        Raises:
+            AIServiceError: If streaming fails
+        """
+        input_data = self._build_input_data(context)
+        logger.info(f"Streaming letter with ID: {context.letter_id}")
+        
+        emitted = 0
+        final: Dict[str, Any] = {}
+        try:
+            async for partial in self.stream_chain.astream(input_data):
+                if not isinstance(partial, dict):
+                    continue
+                final = partial
+                letter_text = partial.get("Letter") or ""
+                if len(letter_text) > emitted:
+                    yield letter_text[emitted:]
+                    emitted = len(letter_text)
+            
+            # Pin the ID like generate_letter does, then apply the same checks
+            letter = LetterOutput.model_validate({**final, "ID": context.letter_id})
+        except Exception as e:
+            logger.error(f"Letter streaming failed for ID {context.letter_id}: {e}")
+            raise AIServiceError(f"Failed to stream letter: {str(e)}")
+        
+        letter = self._to_letter_output(letter)
+        logger.info(f"Letter streamed successfully: {context.letter_id} ({emitted} chars)")
+        yield letter
     
     def validate_letter_content(self, letter: LetterOutput) -> bool:
         """
@@ -294,20 +672,14 @@ class ArabicLetterGenerationService:
             True if letter meets standards, False otherwise
         """
         try:
-            # Check required elements
-            required_elements = [
-                "بسم الله الرحمن الرحيم",
-                "السلام عليكم"
-            ]
-            
-            content_lower = letter.Letter.lower()
-            has_required = any(element.lower() in content_lower for element in required_elements)
+            # Check required elements in a single pass (Arabic has no case, so no lowercasing is needed)
+            has_required = _REQUIRED_RE.search(letter.Letter) is not None
             
             # Check minimum length
             min_length = len(letter.Letter.strip()) >= 100
             
             # Check has Arabic content
-            has_arabic = any('\u0600' <= char <= '\u06FF' for char in letter.Letter)
+            has_arabic = _ARABIC_RE.search(letter.Letter) is not None
             
             return has_required and min_length and has_arabic
             
@@ -320,6 +692,7 @@ class ArabicLetterGenerationService:
         return {
             "service": "ArabicLetterGenerationService",
             "model": self.config.ai.model_name,
+            "structured_output": self.use_structured_output,
             "temperature": self.config.ai.temperature,
             "timeout": self.config.ai.timeout,
             "status": "healthy"
@@ -327,10 +700,13 @@ class ArabicLetterGenerationService:
 
 # Global service instance
 _letter_service = None
+_letter_service_lock = threading.Lock()
 
 def get_letter_service() -> ArabicLetterGenerationService:
-    """Get the global letter generation service instance."""
+    """Get the global letter generation service instance (thread-safe singleton)."""
     global _letter_service
     if _letter_service is None:
-        _letter_service = ArabicLetterGenerationService()
+        with _letter_service_lock:
+            if _letter_service is None:
+                _letter_service = ArabicLetterGenerationService()
     return _letter_service
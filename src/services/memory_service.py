@@ -1,16 +1,30 @@
+import re
+import atexit
 import logging
-import json
+import unicodedata
+import os
 import tempfile
-import shutil
 import threading
 import time
+import heapq
+import hashlib
+import concurrent.futures
 from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional, Annotated, Set
+from typing import Dict, Any, List, Optional, Annotated, Set, Tuple
 from dataclasses import dataclass, field
 from pathlib import Path
 from functools import lru_cache
-from collections import defaultdict
+from itertools import groupby
+from contextlib import contextmanager
+from collections import Counter, OrderedDict, defaultdict
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import orjson
+from rapidfuzz import fuzz, process
 from langchain_openai import ChatOpenAI
 from langchain_core.tools import tool
 from langgraph.graph import StateGraph, START, END
@@ -22,6 +36,57 @@ from ..config import get_config
 
 logger = logging.getLogger(__name__)
 
+_WORD_RE = re.compile(r'\b\w+\b')
+# Common Arabic words ignored when extracting instruction keywords
+_STOP_WORDS = frozenset({"في", "من", "إلى", "على", "مع", "هذا", "هذه", "التي", "الذي", "كل", "بعض"})
+
+# Context keywords -> agent operation, checked in priority order
+_CONTEXT_OPERATIONS = (
+    ("update", ("update", "modify")),
+    ("delete", ("delete", "remove")),
+    ("create", ("add", "create")),
+)
+
+# Letter folding applied after NFKD (which already splits hamza/madda off alef)
+_ARABIC_TRANS = str.maketrans({
+    'ى': 'ي',
+    'ة': 'ه',
+    '\u0640': None,
+})
+
+@lru_cache(maxsize=4096)
+def _normalize_text(text: str) -> str:
+    """Normalize text for similarity comparison (memoized: stored instructions are re-compared often)."""
+    text = text.lower().strip()
+    # Quick Check avoids building a new string when the text is already decomposed
+    if not unicodedata.is_normalized('NFKD', text):
+        text = unicodedata.normalize('NFKD', text)
+    stripped = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return stripped.translate(_ARABIC_TRANS)
+
+@lru_cache(maxsize=4096)
+def _token_set(normalized_text: str) -> frozenset:
+    """Word set of a normalized text, memoized so stored instructions are tokenized once."""
+    return frozenset(normalized_text.split())
+
+def _parse_timestamp(data: Dict[str, Any], name: str) -> datetime:
+    """Read a stored timestamp from its epoch field, parsing the ISO string only for older records."""
+    epoch = data.get(f"{name}_ts")
+    return datetime.fromtimestamp(epoch) if epoch is not None else datetime.fromisoformat(data[name])
+
+def _epoch_of(data: Dict[str, Any], name: str) -> Optional[float]:
+    """Epoch seconds of a stored timestamp, or None when it was never set."""
+    epoch = data.get(f"{name}_ts")
+    if epoch is None and data.get(name):
+        epoch = datetime.fromisoformat(data[name]).timestamp()
+    return epoch
+
+def _extract_keywords(text: str) -> Set[str]:
+    """Extract keywords from instruction text."""
+    # Extract Arabic keywords (remove common stop words)
+    words = _WORD_RE.findall(text.lower())
+    return {word for word in words if len(word) > 2 and word not in _STOP_WORDS}
+
 @dataclass
 class Instruction:
     """Optimized instruction model with enhanced features."""
@@ -39,8 +104,10 @@ class Instruction:
             "id": self.id,
             "text": self.text,
             "created_at": self.created_at.isoformat(),
+            "created_at_ts": int(self.created_at.timestamp()),
             "usage_count": self.usage_count,
             "last_used": self.last_used.isoformat() if self.last_used else None,
+            "last_used_ts": int(self.last_used.timestamp()) if self.last_used else None,
             "category": self.category,
             "keywords": list(self.keywords),
             "effectiveness_score": self.effectiveness_score
@@ -51,9 +118,9 @@ class Instruction:
         return cls(
             id=data["id"],
             text=data["text"],
-            created_at=datetime.fromisoformat(data["created_at"]),
+            created_at=_parse_timestamp(data, "created_at"),
             usage_count=data.get("usage_count", 0),
-            last_used=datetime.fromisoformat(data["last_used"]) if data.get("last_used") else None,
+            last_used=_parse_timestamp(data, "last_used") if data.get("last_used") else None,
             category=data.get("category", "general"),
             keywords=set(data.get("keywords", [])),
             effectiveness_score=data.get("effectiveness_score", 1.0)
@@ -61,11 +128,7 @@ class Instruction:
     
     def extract_keywords(self) -> Set[str]:
         """Extract keywords from instruction text."""
-        import re
-        # Extract Arabic keywords (remove common stop words)
-        stop_words = {"في", "من", "إلى", "على", "مع", "هذا", "هذه", "التي", "الذي", "كل", "بعض"}
-        words = re.findall(r'\b\w+\b', self.text.lower())
-        keywords = {word for word in words if len(word) > 2 and word not in stop_words}
+        keywords = _extract_keywords(self.text)
         self.keywords = keywords
         return keywords
 
@@ -86,18 +149,23 @@ class MemoryCache:
         self._last_modified = {}
     
     def get(self, key: str) -> Optional[Any]:
-        with self._lock:
-            if key in self._cache:
-                timestamp, value = self._cache[key]
-                if time.time() - timestamp < self._ttl:
-                    return value
-                else:
-                    del self._cache[key]
+        # Lock-free read: entries are replaced whole, so a single dict lookup is consistent
+        entry = self._cache.get(key)
+        if entry is None:
             return None
+        
+        timestamp, value = entry
+        if time.monotonic() - timestamp < self._ttl:
+            return value
+        
+        with self._lock:
+            if self._cache.get(key) is entry:
+                del self._cache[key]
+        return None
     
     def set(self, key: str, value: Any):
         with self._lock:
-            self._cache[key] = (time.time(), value)
+            self._cache[key] = (time.monotonic(), value)
     
     def invalidate(self, key: str = None):
         with self._lock:
@@ -106,9 +174,34 @@ class MemoryCache:
             else:
                 self._cache.clear()
 
+# Journal entries applied on top of the snapshot before it is rewritten
+JOURNAL_COMPACT_THRESHOLD = 500
+# Write-behind delay for instruction changes
+JOURNAL_FLUSH_DELAY_SECONDS = 1
+# Delay before buffered usage-stat bumps are journaled
+USAGE_FLUSH_DELAY_SECONDS = 30
+# Quiet period before a session's queued messages are sent to the agent
+MESSAGE_DEBOUNCE_SECONDS = 2.0
+# How long a cached instruction list is trusted before re-checking the files (other workers' writes)
+STORE_RECHECK_SECONDS = 1.0
+# Instructions used within this window get the full recency weight in prompts
+RECENT_USE_SECONDS = 7 * 24 * 3600
+
 # Global instances
 MEMORY_FILE = None
 _memory_cache = MemoryCache()
+_load_lock = threading.Lock()
+_edit_lock = threading.RLock()
+_journal_lock = threading.Lock()
+_journal_size = 0
+_pending_events: List[Dict[str, Any]] = []
+_journal_flush_timer: Optional[threading.Timer] = None
+_pending_usage: Dict[str, Dict[str, Any]] = {}
+_usage_lock = threading.Lock()
+_usage_flush_timer: Optional[threading.Timer] = None
+# Bounded pool for background message analysis (caps concurrent LLM calls)
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="memory")
+atexit.register(_executor.shutdown, wait=False)
 
 def _get_memory_file() -> Path:
     """Get memory file path with caching."""
@@ -117,50 +210,356 @@ def _get_memory_file() -> Path:
         MEMORY_FILE = Path('logs/memory.json')
     return MEMORY_FILE
 
-def _load_instructions_cached() -> List[Dict[str, Any]]:
-    """Load instructions with caching for better performance."""
-    cache_key = "instructions"
-    cached = _memory_cache.get(cache_key)
+def _get_journal_file() -> Path:
+    """Get the append-only journal path that sits next to the memory snapshot."""
+    memory_file = _get_memory_file()
+    return memory_file.with_name(f"{memory_file.stem}.journal.jsonl")
+
+def _apply_events(instructions: List[Dict[str, Any]], events) -> List[Dict[str, Any]]:
+    """Apply upsert/delete events to an instruction list."""
+    positions = {instr['id']: i for i, instr in enumerate(instructions)}
+    for event in events:
+        if event["op"] == "upsert":
+            instr = event["instruction"]
+            position = positions.get(instr['id'])
+            if position is None:
+                positions[instr['id']] = len(instructions)
+                instructions.append(instr)
+            else:
+                instructions[position] = instr
+        elif event["op"] == "delete":
+            position = positions.pop(event["id"], None)
+            if position is not None:
+                instructions[position] = None
     
-    if cached is not None:
+    return [instr for instr in instructions if instr is not None]
+
+def _replay_journal(instructions: List[Dict[str, Any]], journal_file: Path) -> List[Dict[str, Any]]:
+    """Apply journaled upserts/deletes to the snapshot instructions."""
+    global _journal_size
+    if not journal_file.exists():
+        _journal_size = 0
+        return instructions
+    
+    with open(journal_file, 'rb') as f:
+        events = [orjson.loads(line) for line in f if line.strip()]
+    
+    _journal_size = len(events)
+    return _apply_events(instructions, events)
+
+def _store_signature() -> tuple:
+    """Stat fingerprint of the snapshot and journal, used to notice writes from other processes."""
+    signature = []
+    for path in (_get_memory_file(), _get_journal_file()):
+        try:
+            stat = path.stat()
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+def _cache_instructions(instructions: List[Dict[str, Any]]):
+    """Cache the instruction list together with the store signature it reflects."""
+    _memory_cache.set("instructions", instructions)
+    _memory_cache.set("store_signature", _store_signature())
+    _memory_cache.set("store_checked_at", time.monotonic())
+
+def _get_cached_instructions() -> Optional[List[Dict[str, Any]]]:
+    """
+    Return the cached instructions unless the files on disk changed since they were cached.
+    The files are stat'ed at most once per STORE_RECHECK_SECONDS, so another worker's write
+    can go unnoticed for that long.
+    """
+    cached = _memory_cache.get("instructions")
+    if cached is None:
+        return None
+    
+    now = time.monotonic()
+    checked_at = _memory_cache.get("store_checked_at")
+    if checked_at is not None and now - checked_at < STORE_RECHECK_SECONDS:
         return cached
     
+    if _memory_cache.get("store_signature") == _store_signature():
+        _memory_cache.set("store_checked_at", now)
+        return cached
+    return None
+
+@contextmanager
+def _store_file_lock(shared: bool = False):
+    """
+    Hold an advisory lock on the memory store across processes (worker processes share the files).
+    Falls back to in-process locking only where fcntl is unavailable.
+    """
+    if fcntl is None:
+        yield
+        return
+    
+    lock_file = _get_memory_file().with_suffix('.lock')
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_file, 'ab') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _read_store() -> List[Dict[str, Any]]:
+    """Read the snapshot, replay the journal, and apply this process's unflushed changes."""
     memory_file = _get_memory_file()
     instructions = []
+    if memory_file.exists():
+        with open(memory_file, 'rb') as f:
+            data = orjson.loads(f.read())
+        instructions = data.get("instructions", [])
+    instructions = _replay_journal(instructions, _get_journal_file())
+    # Changes from this process that are not flushed yet
+    return _apply_events(instructions, list(_pending_events))
+
+def _load_instructions_cached() -> List[Dict[str, Any]]:
+    """Load instructions with caching for better performance."""
+    cached = _get_cached_instructions()
     
-    try:
-        if memory_file.exists():
-            with open(memory_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            instructions = data.get("instructions", [])
+    if cached is not None:
+        return cached
+    
+    # Single-flight: concurrent requests on a cold cache wait for one load
+    with _load_lock:
+        cached = _get_cached_instructions()
+        if cached is not None:
+            return cached
         
-        _memory_cache.set(cache_key, instructions)
-        return instructions
-    except Exception as e:
-        logger.error(f"Failed to load instructions: {e}")
-        return []
+        try:
+            # Shared lock: never read a new snapshot's journal truncation with the old snapshot
+            with _store_file_lock(shared=True):
+                instructions = _read_store()
+                _cache_instructions(instructions)
+            return instructions
+        except Exception as e:
+            logger.error(f"Failed to load instructions: {e}")
+            return []
+
+@contextmanager
+def _editing_instructions():
+    """
+    Yield the cached instruction list for a read-modify-write.
+    Edits are serialized so concurrent tool calls cannot drop each other's changes.
+    """
+    with _edit_lock:
+        yield _load_instructions_cached()
 
 def _save_data_atomically(data: Dict[str, Any], file_path: Path):
     """Save data atomically to prevent corruption with cache invalidation."""
     file_path.parent.mkdir(parents=True, exist_ok=True)
     
     # Write to temporary file first
-    with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', 
+    with tempfile.NamedTemporaryFile(mode='wb', 
                                    dir=file_path.parent, 
                                    delete=False, suffix='.tmp') as tmp_file:
-        json.dump(data, tmp_file, ensure_ascii=False, indent=2)
+        tmp_file.write(orjson.dumps(data))
+        # Make the data durable before the rename exposes it
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
         tmp_file_path = tmp_file.name
     
     # Atomic move
-    shutil.move(tmp_file_path, file_path)
+    os.replace(tmp_file_path, file_path)
     
     # Invalidate cache
     _memory_cache.invalidate("instructions")
+    _invalidate_indexes()
     logger.debug("Memory cache invalidated after save")
 
-@tool
-def load_instructions() -> str:
-    """Load all instructions from database with optimized performance."""
+def _record_changes(instructions: List[Dict[str, Any]], upserted: List[Dict[str, Any]] = (), deleted_ids: List[str] = ()):
+    """
+    Apply instruction changes in memory and queue them for the journal (write-behind).
+    
+    `instructions` is the full post-change list and becomes the cached state right away;
+    the events are appended to the journal JOURNAL_FLUSH_DELAY_SECONDS later.
+    """
+    global _journal_flush_timer
+    events = [{"op": "upsert", "instruction": instr} for instr in upserted]
+    events += [{"op": "delete", "id": instr_id} for instr_id in deleted_ids]
+    if not events:
+        return
+    
+    with _journal_lock:
+        _pending_events.extend(events)
+        _memory_cache.set("instructions", instructions)
+        _invalidate_indexes()
+        
+        if _journal_flush_timer is None:
+            _journal_flush_timer = threading.Timer(JOURNAL_FLUSH_DELAY_SECONDS, _flush_journal)
+            _journal_flush_timer.daemon = True
+            _journal_flush_timer.start()
+
+def _flush_journal():
+    """Append queued events to the journal, compacting into the snapshot when it grows large."""
+    global _journal_size, _journal_flush_timer
+    with _journal_lock:
+        if _journal_flush_timer is not None:
+            _journal_flush_timer.cancel()
+            _journal_flush_timer = None
+        if not _pending_events:
+            return
+        
+        events = list(_pending_events)
+        _pending_events.clear()
+        
+        try:
+            journal_file = _get_journal_file()
+            journal_file.parent.mkdir(parents=True, exist_ok=True)
+            
+            # Exclusive lock: another worker must not append between our snapshot and truncate
+            with _store_file_lock():
+                # Only carry the cache forward if nothing else wrote since it was cached
+                cache_is_current = _memory_cache.get("store_signature") == _store_signature()
+                with open(journal_file, 'ab') as f:
+                    f.write(b"".join(orjson.dumps(event) + b"\n" for event in events))
+                _journal_size += len(events)
+                if cache_is_current:
+                    _memory_cache.set("store_signature", _store_signature())
+                
+                if _journal_size >= JOURNAL_COMPACT_THRESHOLD:
+                    instructions = _memory_cache.get("instructions") if cache_is_current else None
+                    if instructions is None:
+                        instructions = _read_store()
+                    data = {
+                        "instructions": instructions,
+                        "last_updated": datetime.now().isoformat(),
+                        "stats": {"total_instructions": len(instructions)}
+                    }
+                    _save_data_atomically(data, _get_memory_file())
+                    # Snapshot first, then truncate: replaying an already-applied journal is harmless
+                    open(journal_file, 'w').close()
+                    _journal_size = 0
+                    logger.debug("Memory journal compacted into snapshot")
+        except Exception as e:
+            logger.error(f"Failed to flush memory journal: {e}")
+            _pending_events[:0] = events
+
+atexit.register(_flush_journal)
+
+def _record_usage(used: List[Dict[str, Any]]):
+    """Buffer usage-stat bumps and journal them in one batch later."""
+    global _usage_flush_timer
+    with _usage_lock:
+        for instr in used:
+            _pending_usage[instr['id']] = instr
+        
+        if _usage_flush_timer is None:
+            _usage_flush_timer = threading.Timer(USAGE_FLUSH_DELAY_SECONDS, _flush_usage)
+            _usage_flush_timer.daemon = True
+            _usage_flush_timer.start()
+
+def _flush_usage():
+    """Journal buffered usage stats onto the current instruction list."""
+    global _usage_flush_timer
+    with _usage_lock:
+        pending = dict(_pending_usage)
+        _pending_usage.clear()
+        if _usage_flush_timer is not None:
+            _usage_flush_timer.cancel()
+            _usage_flush_timer = None
+    
+    if not pending:
+        return
+    
+    try:
+        # The cache may have been reloaded since the bump; carry the stats over by id
+        with _editing_instructions() as instructions:
+            by_id = _id_index(instructions)
+            updated = []
+            for instr_id, used in pending.items():
+                instr = by_id.get(instr_id)
+                if instr is not None:
+                    instr['usage_count'] = used.get('usage_count', 0)
+                    instr['last_used'] = used.get('last_used')
+                    instr['last_used_ts'] = used.get('last_used_ts')
+                    updated.append(instr)
+            _record_changes(instructions, upserted=updated)
+    except Exception as e:
+        logger.error(f"Failed to flush instruction usage stats: {e}")
+
+atexit.register(_flush_usage)
+
+def _mark_used(instr: Dict[str, Any], now: datetime):
+    """Stamp an instruction as used now, keeping the ISO string and its epoch in step."""
+    instr['last_used'] = now.isoformat()
+    instr['last_used_ts'] = int(now.timestamp())
+
+def _bump_usage(selected: List[Dict[str, Any]], now: datetime):
+    """Count a prompt use of the selected instructions; persisted later by the usage flush."""
+    for instr in selected:
+        instr['usage_count'] = instr.get('usage_count', 0) + 1
+        _mark_used(instr, now)
+    
+    if selected:
+        _record_usage(selected)
+
+def _prompt_score(instr: Dict[str, Any], now_ts: float) -> float:
+    """Rank an instruction for the prompt by effectiveness, usage, and recency."""
+    # Never-used instructions count as used when they were created
+    last_used = _epoch_of(instr, 'last_used') or _epoch_of(instr, 'created_at')
+    return (
+        instr.get('effectiveness_score', 1.0) * 0.4 +
+        min(instr.get('usage_count', 0) / 10, 3.0) * 0.4 +
+        (1.0 if last_used is not None and now_ts - last_used < RECENT_USE_SECONDS else 0.5) * 0.2
+    )
+
+def _select_prompt_instructions(instructions: List[Dict[str, Any]], now: datetime, limit: int = 8) -> List[Dict[str, Any]]:
+    """
+    Return the top instructions for the prompt, best first.
+    
+    The full ranking runs once per version of the instruction list; later calls only
+    re-order the cached winners. That stays exact between changes: using the winners
+    only raises their scores, and everyone else's score can only drop as they age.
+    """
+    now_ts = now.timestamp()
+    top = _cached_index("prompt_top", instructions, lambda items: heapq.nlargest(limit, items, key=lambda x: _prompt_score(x, now_ts)))
+    return sorted(top, key=lambda x: _prompt_score(x, now_ts), reverse=True)
+
+def _use_prompt_instructions(instructions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Pick the top instructions for a prompt and count the use."""
+    now = datetime.now()
+    
+    # Top 8 by effectiveness, usage, and recency
+    selected = _select_prompt_instructions(instructions, now)
+    
+    # Update usage stats off the read path
+    _bump_usage(selected, now)
+    return selected
+
+def _format_instruction_texts(instructions: List[Dict[str, Any]]) -> str:
+    """Format prompt instructions as a plain list of their texts, without categories."""
+    formatted = ["## تعليمات من ذاكرة المستخدم:"]
+    
+    for instr in instructions:
+        formatted.append(f"• {instr['text']}")
+    
+    return "\n".join(formatted) + "\n"
+
+def _format_by_category(instructions: List[Dict[str, Any]]) -> str:
+    """Format prompt instructions grouped under their category headings."""
+    # Stable sort by each category's first appearance keeps categories and ranks in order
+    first_seen = {}
+    for instr in instructions:
+        first_seen.setdefault(instr.get('category', 'general'), len(first_seen))
+    grouped = sorted(instructions, key=lambda x: first_seen[x.get('category', 'general')])
+    
+    formatted = ["## تعليمات من ذاكرة المستخدم:"]
+    
+    for category, instrs in groupby(grouped, key=lambda x: x.get('category', 'general')):
+        if category != 'general':
+            formatted.append(f"\n### {category}:")
+        for instr in instrs:
+            effectiveness = instr.get('effectiveness_score', 1.0)
+            usage = instr.get('usage_count', 0)
+            formatted.append(f"• {instr['text']} (فعالية: {effectiveness:.1f}, استخدام: {usage})")
+    
+    return "\n".join(formatted) + "\n"
+
+def _render_saved_instructions() -> str:
+    """Format every stored instruction, best first (shared by the tool and the agent prompt)."""
     try:
         instructions = _load_instructions_cached()
         
@@ -174,17 +573,22 @@ def load_instructions() -> str:
             reverse=True
         )
         
-        result = "التعليمات المحفوظة حالياً:\n"
-        for i, instr_data in enumerate(sorted_instructions, 1):
-            usage = instr_data.get('usage_count', 0)
-            effectiveness = instr_data.get('effectiveness_score', 1.0)
-            result += f"{i}. {instr_data['text']} (استخدام: {usage}, فعالية: {effectiveness:.1f})\n"
-        return result
+        lines = ["التعليمات المحفوظة حالياً:"]
+        lines.extend(
+            f"{i}. {instr_data['text']} (استخدام: {instr_data.get('usage_count', 0)}, فعالية: {instr_data.get('effectiveness_score', 1.0):.1f})"
+            for i, instr_data in enumerate(sorted_instructions, 1)
+        )
+        return "\n".join(lines) + "\n"
         
     except Exception as e:
         logger.error(f"Failed to load instructions: {e}")
         return "خطأ في تحميل التعليمات"
 
+@tool
+def load_instructions() -> str:
+    """Load all instructions from database with optimized performance."""
+    return _render_saved_instructions()
+
 @tool
 def add_instruction(instruction_text: str, category: str = "general") -> str:
     """Add new instruction to database with enhanced features."""
@@ -196,52 +600,47 @@ def add_instruction(instruction_text: str, category: str = "general") -> str:
         instruction_text = instruction_text.strip()
         
         # Load existing instructions
-        instructions = _load_instructions_cached()
-        
-        # Check for duplicates with improved similarity detection
-        for instr_data in instructions:
-            if _is_similar_text(instruction_text, instr_data['text'], threshold=0.8):
-                # Update existing instruction instead of creating duplicate
-                instr_data['usage_count'] = instr_data.get('usage_count', 0) + 1
-                instr_data['last_used'] = datetime.now().isoformat()
-                instr_data['effectiveness_score'] = min(instr_data.get('effectiveness_score', 1.0) + 0.1, 5.0)
-                
-                # Save updates
-                data = {
-                    "instructions": instructions,
-                    "last_updated": datetime.now().isoformat(),
-                    "stats": {"total_instructions": len(instructions)}
-                }
-                _save_data_atomically(data, _get_memory_file())
-                
-                return f"تم تحديث تعليم مشابه موجود: {instr_data['text']}"
-        
-        # Create new instruction
-        instruction_id = f"instr_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        new_instruction = Instruction(
-            id=instruction_id,
-            text=instruction_text,
-            created_at=datetime.now(),
-            usage_count=1,
-            last_used=datetime.now(),
-            category=category
-        )
-        
-        # Extract keywords
-        new_instruction.extract_keywords()
-        
-        instructions.append(new_instruction.to_dict())
-        
-        # Save atomically
-        data = {
-            "instructions": instructions,
-            "last_updated": datetime.now().isoformat(),
-            "stats": {"total_instructions": len(instructions)}
-        }
-        _save_data_atomically(data, _get_memory_file())
-        
-        logger.info(f"Added instruction: {instruction_text}")
-        return f"تم إضافة التعليم الجديد: {instruction_text}"
+        with _editing_instructions() as instructions:
+            
+            now = datetime.now()
+            
+            # Check for duplicates: exact normalized match first, then similarity
+            normalized_text = _normalize_text(instruction_text)
+            exact_match = _cached_index("text_index", instructions, _build_text_index).get(normalized_text)
+            candidates = [exact_match] if exact_match is not None else _candidate_instructions(normalized_text, instructions, min_score=0.8)
+            for instr_data in candidates:
+                if _similarity_of_normalized(normalized_text, _normalize_text(instr_data['text']), min_score=0.8) >= 0.8:
+                    # Update existing instruction instead of creating duplicate
+                    instr_data['usage_count'] = instr_data.get('usage_count', 0) + 1
+                    _mark_used(instr_data, now)
+                    instr_data['effectiveness_score'] = min(instr_data.get('effectiveness_score', 1.0) + 0.1, 5.0)
+                    
+                    # Save updates
+                    _record_changes(instructions, upserted=[instr_data])
+                    
+                    return f"تم تحديث تعليم مشابه موجود: {instr_data['text']}"
+            
+            # Create new instruction
+            instruction_id = f"instr_{now.strftime('%Y%m%d_%H%M%S_%f')}"
+            new_instruction = Instruction(
+                id=instruction_id,
+                text=instruction_text,
+                created_at=now,
+                usage_count=1,
+                category=category
+            )
+            
+            # Extract keywords
+            new_instruction.extract_keywords()
+            
+            instruction_data = new_instruction.to_dict()
+            instructions.append(instruction_data)
+            
+            # Save changes
+            _record_changes(instructions, upserted=[instruction_data])
+            
+            logger.info(f"Added instruction: {instruction_text}")
+            return f"تم إضافة التعليم الجديد: {instruction_text}"
         
     except Exception as e:
         logger.error(f"Failed to add instruction: {e}")
@@ -255,48 +654,41 @@ def update_instruction(old_text: str, new_text: str) -> str:
         if not old_text or not new_text or not old_text.strip() or not new_text.strip():
             return "النص المدخل فارغ"
         
-        instructions = _load_instructions_cached()
-        
-        if not instructions:
-            return "لا توجد تعليمات لتحديثها"
-        
-        updated = False
-        best_match = None
-        best_similarity = 0
-        
-        # Find best matching instruction
-        for instr_data in instructions:
-            similarity = _calculate_similarity(old_text.strip(), instr_data['text'])
-            if similarity > best_similarity and similarity > 0.6:  # 60% threshold
-                best_similarity = similarity
-                best_match = instr_data
-        
-        if best_match:
-            old_value = best_match['text']
-            best_match['text'] = new_text.strip()
-            best_match['last_used'] = datetime.now().isoformat()
-            best_match['usage_count'] = best_match.get('usage_count', 0) + 1
-            best_match['effectiveness_score'] = min(best_match.get('effectiveness_score', 1.0) + 0.2, 5.0)
-            
-            # Update keywords if instruction object
-            if 'keywords' in best_match:
-                instr_obj = Instruction.from_dict(best_match)
-                instr_obj.text = new_text.strip()
-                instr_obj.extract_keywords()
-                best_match = instr_obj.to_dict()
-            
-            # Save updates
-            data = {
-                "instructions": instructions,
-                "last_updated": datetime.now().isoformat(),
-                "stats": {"total_instructions": len(instructions)}
-            }
-            _save_data_atomically(data, _get_memory_file())
+        with _editing_instructions() as instructions:
+            
+            if not instructions:
+                return "لا توجد تعليمات لتحديثها"
             
-            logger.info(f"Updated instruction: {old_value} -> {new_text}")
-            return f"تم تحديث التعليم من '{old_value}' إلى '{new_text}' (تشابه: {best_similarity:.1%})"
-        else:
-            return f"لم يتم العثور على تعليم مشابه لـ: {old_text}"
+            updated = False
+            best_match = None
+            best_similarity = 0
+            
+            # Find best matching instruction
+            normalized_old = _normalize_text(old_text)
+            for instr_data in _candidate_instructions(normalized_old, instructions, min_score=0.6):
+                similarity = _similarity_of_normalized(normalized_old, _normalize_text(instr_data['text']), min_score=0.6)
+                if similarity > best_similarity and similarity > 0.6:  # 60% threshold
+                    best_similarity = similarity
+                    best_match = instr_data
+            
+            if best_match:
+                old_value = best_match['text']
+                best_match['text'] = new_text.strip()
+                _mark_used(best_match, datetime.now())
+                best_match['usage_count'] = best_match.get('usage_count', 0) + 1
+                best_match['effectiveness_score'] = min(best_match.get('effectiveness_score', 1.0) + 0.2, 5.0)
+                
+                # Update keywords if instruction object
+                if 'keywords' in best_match:
+                    best_match['keywords'] = list(_extract_keywords(best_match['text']))
+                
+                # Save updates
+                _record_changes(instructions, upserted=[best_match])
+                
+                logger.info(f"Updated instruction: {old_value} -> {new_text}")
+                return f"تم تحديث التعليم من '{old_value}' إلى '{new_text}' (تشابه: {best_similarity:.1%})"
+            else:
+                return f"لم يتم العثور على تعليم مشابه لـ: {old_text}"
             
     except Exception as e:
         logger.error(f"Failed to update instruction: {e}")
@@ -306,35 +698,38 @@ def update_instruction(old_text: str, new_text: str) -> str:
 def delete_instruction(instruction_text: str) -> str:
     """Delete instruction from database with improved matching."""
     try:
-        instructions = _load_instructions_cached()
-        
-        if not instructions:
-            return "لا توجد تعليمات لحذفها"
-        
-        original_count = len(instructions)
-        deleted_instruction = None
-        
-        # Find and remove best matching instruction
-        remaining_instructions = []
-        for instr in instructions:
-            if _is_similar_text(instruction_text, instr['text'], threshold=0.7):
-                deleted_instruction = instr['text']
-            else:
-                remaining_instructions.append(instr)
-        
-        if len(remaining_instructions) < original_count:
-            # Save updates
-            data = {
-                "instructions": remaining_instructions,
-                "last_updated": datetime.now().isoformat(),
-                "stats": {"total_instructions": len(remaining_instructions)}
+        with _editing_instructions() as instructions:
+            
+            if not instructions:
+                return "لا توجد تعليمات لحذفها"
+            
+            original_count = len(instructions)
+            deleted_instruction = None
+            
+            # Find and remove best matching instruction
+            normalized_text = _normalize_text(instruction_text)
+            matched_ids = {
+                id(instr) for instr in _candidate_instructions(normalized_text, instructions, min_score=0.7)
+                if _similarity_of_normalized(normalized_text, _normalize_text(instr['text']), min_score=0.7) >= 0.7
             }
-            _save_data_atomically(data, _get_memory_file())
             
-            logger.info(f"Deleted instruction: {deleted_instruction}")
-            return f"تم حذف التعليم: {deleted_instruction}"
-        else:
-            return f"لم يتم العثور على تعليم مطابق لـ: {instruction_text}"
+            remaining_instructions = []
+            deleted_ids = []
+            for instr in instructions:
+                if id(instr) in matched_ids:
+                    deleted_instruction = instr['text']
+                    deleted_ids.append(instr['id'])
+                else:
+                    remaining_instructions.append(instr)
+            
+            if len(remaining_instructions) < original_count:
+                # Save updates
+                _record_changes(remaining_instructions, deleted_ids=deleted_ids)
+                
+                logger.info(f"Deleted instruction: {deleted_instruction}")
+                return f"تم حذف التعليم: {deleted_instruction}"
+            else:
+                return f"لم يتم العثور على تعليم مطابق لـ: {instruction_text}"
             
     except Exception as e:
         logger.error(f"Failed to delete instruction: {e}")
@@ -349,51 +744,10 @@ def get_instructions_for_prompt() -> str:
         if not instructions:
             return ""
         
-        # Sort by effectiveness, usage, and recency
-        sorted_instructions = sorted(
-            instructions,
-            key=lambda x: (
-                x.get('effectiveness_score', 1.0) * 0.4 +
-                min(x.get('usage_count', 0) / 10, 3.0) * 0.4 +
-                (1.0 if x.get('last_used') and 
-                 (datetime.now() - datetime.fromisoformat(x['last_used'])).days < 7 
-                 else 0.5) * 0.2
-            ),
-            reverse=True
-        )[:8]  # Top 8 instructions
-        
-        # Update usage stats for selected instructions
-        current_time = datetime.now().isoformat()
-        for instr in sorted_instructions:
-            instr['usage_count'] = instr.get('usage_count', 0) + 1
-            instr['last_used'] = current_time
-        
-        # Save updated stats
-        if sorted_instructions:
-            data = {
-                "instructions": instructions,
-                "last_updated": current_time,
-                "stats": {"total_instructions": len(instructions)}
-            }
-            _save_data_atomically(data, _get_memory_file())
+        sorted_instructions = _use_prompt_instructions(instructions)
         
         # Format for AI prompt with categories
-        categories = defaultdict(list)
-        for instr in sorted_instructions:
-            category = instr.get('category', 'general')
-            categories[category].append(instr)
-        
-        formatted = ["## تعليمات من ذاكرة المستخدم:"]
-        
-        for category, instrs in categories.items():
-            if category != 'general':
-                formatted.append(f"\n### {category}:")
-            for instr in instrs:
-                effectiveness = instr.get('effectiveness_score', 1.0)
-                usage = instr.get('usage_count', 0)
-                formatted.append(f"• {instr['text']} (فعالية: {effectiveness:.1f}, استخدام: {usage})")
-        
-        return "\n".join(formatted) + "\n"
+        return _format_by_category(sorted_instructions)
         
     except Exception as e:
         logger.error(f"Failed to get instructions: {e}")
@@ -404,42 +758,149 @@ def _calculate_similarity(text1: str, text2: str) -> float:
     if not text1 or not text2:
         return 0.0
     
-    # Normalize texts
-    text1, text2 = text1.lower().strip(), text2.lower().strip()
+    return _similarity_of_normalized(_normalize_text(text1), _normalize_text(text2))
+
+@lru_cache(maxsize=8192)
+def _similarity_of_normalized(text1: str, text2: str, min_score: float = 0.0) -> float:
+    """
+    Calculate similarity between two texts already passed through _normalize_text.
+    Returns 0.0 early when the score provably cannot reach min_score.
+    Memoized per pair: the agent often re-probes the same text against the same store.
+    """
+    if not text1 or not text2:
+        return 0.0
     
     if text1 == text2:
         return 1.0
     
+    # The character ratio is at most 2*min(len)/(len1+len2) and Jaccard at most 1, so very
+    # different lengths are rejected with integer math before touching the word sets
+    len1, len2 = len(text1), len(text2)
+    length_bound = 0.8 * min(len1, len2) / (len1 + len2)
+    if 0.6 + length_bound < min_score:
+        return 0.0
+    
     # Jaccard similarity (word-based)
-    words1, words2 = set(text1.split()), set(text2.split())
+    words1, words2 = _token_set(text1), _token_set(text2)
     
     if not words1 or not words2:
         return 0.0
     
-    jaccard = len(words1 & words2) / len(words1 | words2)
+    shared = len(words1 & words2)
+    jaccard = shared / (len(words1) + len(words2) - shared)
+    
+    # Same bound with the actual Jaccard; skip the character ratio if it can't reach min_score
+    if jaccard * 0.6 + length_bound < min_score:
+        return 0.0
     
     # Character-based similarity (for Arabic text)
-    from difflib import SequenceMatcher
-    char_similarity = SequenceMatcher(None, text1, text2).ratio()
+    char_similarity = fuzz.ratio(text1, text2) / 100.0
     
     # Combined similarity
     return (jaccard * 0.6 + char_similarity * 0.4)
 
 def _is_similar_text(text1: str, text2: str, threshold: float = 0.75) -> bool:
     """Check if two texts are similar with configurable threshold."""
-    similarity = _calculate_similarity(text1, text2)
+    if not text1 or not text2:
+        return False
+    
+    # Exact repeats (the common retry case) need no normalization or scoring
+    if text1 == text2:
+        return True
+    
+    similarity = _similarity_of_normalized(_normalize_text(text1), _normalize_text(text2), min_score=threshold)
     return similarity >= threshold
 
+def _invalidate_indexes():
+    """Drop indexes derived from the cached instruction list."""
+    _memory_cache.invalidate("token_index")
+    _memory_cache.invalidate("id_index")
+    _memory_cache.invalidate("text_index")
+    _memory_cache.invalidate("size_index")
+    _memory_cache.invalidate("prompt_top")
+
+def _cached_index(name: str, instructions: List[Dict[str, Any]], build) -> Any:
+    """Return an index built from this exact instruction list, rebuilding it when the list changes."""
+    cached = _memory_cache.get(name)
+    if cached is None or cached[0] is not instructions:
+        cached = (instructions, build(instructions))
+        _memory_cache.set(name, cached)
+    return cached[1]
+
+def _build_token_index(instructions: List[Dict[str, Any]]) -> Dict[str, List[int]]:
+    """Map each normalized word to the positions of the instructions containing it."""
+    index = defaultdict(list)
+    for position, instr in enumerate(instructions):
+        for token in _token_set(_normalize_text(instr['text'])):
+            index[token].append(position)
+    return index
+
+def _id_index(instructions: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Map instruction id to its dict in the cached list."""
+    return _cached_index("id_index", instructions, lambda items: {instr['id']: instr for instr in items})
+
+def _build_text_index(instructions: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Map each normalized text to the first instruction that has it."""
+    index = {}
+    for instr in instructions:
+        index.setdefault(_normalize_text(instr['text']), instr)
+    return index
+
+def _build_size_index(instructions: List[Dict[str, Any]]) -> List[tuple]:
+    """(character length, word count) of each normalized instruction text, by position."""
+    sizes = []
+    for instr in instructions:
+        normalized = _normalize_text(instr['text'])
+        sizes.append((len(normalized), len(_token_set(normalized))))
+    return sizes
+
+def _candidate_instructions(normalized_text: str, instructions: List[Dict[str, Any]], min_score: float = 0.0) -> List[Dict[str, Any]]:
+    """
+    Return instructions sharing at least one normalized word with the text, in stored order.
+    
+    Without a shared word the Jaccard term is 0 and the blended score is capped at 0.4,
+    below every matching threshold, so skipping those instructions changes no result.
+    The index hit count per instruction is its shared-word count, which gives the exact
+    Jaccard term; together with the length cap on the character term this drops every
+    instruction that cannot reach min_score (the same bound _similarity_of_normalized applies).
+    """
+    token_index = _cached_index("token_index", instructions, _build_token_index)
+    words = _token_set(normalized_text)
+    hits = Counter(position for token in words for position in token_index.get(token, ()))
+    
+    if min_score > 0.4 and hits:
+        sizes = _cached_index("size_index", instructions, _build_size_index)
+        target_len, target_words = len(normalized_text), len(words)
+        for position, shared in list(hits.items()):
+            length, word_count = sizes[position]
+            jaccard = shared / (target_words + word_count - shared)
+            if jaccard * 0.6 + 0.8 * min(target_len, length) / (target_len + length) < min_score:
+                del hits[position]
+    
+    return [instructions[position] for position in sorted(hits)]
+
 class MemoryService:
     """Optimized memory service with enhanced user message handling."""
     
     def __init__(self):
         self.config = get_config()
-        self.agent = self._build_agent()
+        self._agent = None
+        self._agent_lock = threading.Lock()
         self._processing_lock = threading.Lock()
-        self._last_processed = {}
+        self._last_processed: "OrderedDict[bytes, float]" = OrderedDict()
+        self._pending_lock = threading.Lock()
+        self._pending_messages: Dict[str, Dict[str, Any]] = {}
         logger.info("Optimized memory service initialized")
     
+    @property
+    def agent(self):
+        """LangGraph agent, built on first use so read-only callers never create the LLM client."""
+        if self._agent is None:
+            with self._agent_lock:
+                if self._agent is None:
+                    self._agent = self._build_agent()
+        return self._agent
+    
     def _build_agent(self):
         """Build optimized LangGraph agent with memory tools."""
         # Define enhanced tools
@@ -472,8 +933,8 @@ class MemoryService:
             user_msg = state['user_message']
             operation = state.get('instruction_operation', 'analyze')
             
-            # Get current instructions for context
-            current_instructions = load_instructions.invoke({})
+            # Get current instructions for context (direct call, no tool round-trip)
+            current_instructions = _render_saved_instructions()
             
             # Enhanced prompt for better user message understanding
             prompt = f"""
@@ -534,7 +995,7 @@ class MemoryService:
         """Process message with enhanced analysis and deduplication."""
         
         # Prevent duplicate processing
-        message_hash = str(hash(message.strip().lower()))
+        message_hash = hashlib.blake2s(message.strip().lower().encode('utf-8'), digest_size=8).digest()
         
         with self._processing_lock:
             last_time = self._last_processed.get(message_hash)
@@ -563,12 +1024,11 @@ class MemoryService:
             # Update last processed time
             with self._processing_lock:
                 self._last_processed[message_hash] = time.time()
+                self._last_processed.move_to_end(message_hash)
                 
-                # Cleanup old entries (keep last 100)
-                if len(self._last_processed) > 100:
-                    oldest_items = sorted(self._last_processed.items(), key=lambda x: x[1])[:20]
-                    for item_hash, _ in oldest_items:
-                        del self._last_processed[item_hash]
+                # Cleanup old entries (keep last 100); insertion order is processing order
+                while len(self._last_processed) > 100:
+                    self._last_processed.popitem(last=False)
             
             return {
                 "status": "processed",
@@ -581,32 +1041,119 @@ class MemoryService:
             return {"status": "error", "error": str(e)}
     
     def process_message_async(self, session_id: str, message: str, context: str = ""):
-        """Process message asynchronously with improved error handling."""
+        """
+        Process message asynchronously with improved error handling.
         
-        def _process():
-            try:
-                # Determine operation based on context
-                operation = "analyze"
-                if "update" in context.lower() or "modify" in context.lower():
-                    operation = "update"
-                elif "delete" in context.lower() or "remove" in context.lower():
-                    operation = "delete"
-                elif "add" in context.lower() or "create" in context.lower():
-                    operation = "create"
-                
-                result = self.process_message(message, operation)
+        Messages from the same session arriving within MESSAGE_DEBOUNCE_SECONDS of each
+        other are analyzed together, with one agent run per distinct context.
+        """
+        with self._pending_lock:
+            pending = self._pending_messages.get(session_id)
+            if pending is None:
+                pending = {"messages": [], "last_seen": 0.0}
+                self._pending_messages[session_id] = pending
+                # One timer per burst; later messages only push last_seen forward
+                self._schedule_drain(session_id, MESSAGE_DEBOUNCE_SECONDS)
+            
+            if (message, context) not in pending["messages"]:
+                pending["messages"].append((message, context))
+            pending["last_seen"] = time.monotonic()
+    
+    def _schedule_drain(self, session_id: str, delay: float):
+        """Arm the debounce timer for a session, so waiting never occupies a pool worker."""
+        timer = threading.Timer(delay, self._drain_pending, args=(session_id,))
+        timer.daemon = True
+        timer.start()
+    
+    def _drain_pending(self, session_id: str):
+        """Hand a session's coalesced messages to the background pool once it has gone quiet."""
+        with self._pending_lock:
+            pending = self._pending_messages[session_id]
+            remaining = pending["last_seen"] + MESSAGE_DEBOUNCE_SECONDS - time.monotonic()
+            if remaining > 0:
+                self._schedule_drain(session_id, remaining)
+                return
+            del self._pending_messages[session_id]
+        
+        # Only messages sharing a context are joined, since the context picks the operation
+        batches: Dict[str, List[str]] = {}
+        for message, context in pending["messages"]:
+            batches.setdefault(context, []).append(message)
+        
+        for context, messages in batches.items():
+            # Run on the background pool to prevent blocking
+            _executor.submit(self._process_in_background, session_id, "\n".join(messages), context)
+    
+    def _process_in_background(self, session_id: str, message: str, context: str):
+        """Analyze a message off the request thread, logging instead of raising."""
+        try:
+            # Determine operation based on context
+            context_lower = context.lower()
+            operation = next(
+                (op for op, keywords in _CONTEXT_OPERATIONS if any(k in context_lower for k in keywords)),
+                "analyze"
+            )
+            
+            result = self.process_message(message, operation)
+            
+            if result["status"] == "error":
+                logger.error(f"Async processing failed for session {session_id}: {result['error']}")
+            elif result["status"] == "processed":
+                logger.info(f"Async processing completed for session {session_id}: {result['actions']}")
                 
-                if result["status"] == "error":
-                    logger.error(f"Async processing failed for session {session_id}: {result['error']}")
-                elif result["status"] == "processed":
-                    logger.info(f"Async processing completed for session {session_id}: {result['actions']}")
-                    
-            except Exception as e:
-                logger.error(f"Async memory processing failed for session {session_id}: {e}")
+        except Exception as e:
+            logger.error(f"Async memory processing failed for session {session_id}: {e}")
+    
+    def add_instructions(self, instruction_texts: List[str], category: str = "general") -> Dict[str, int]:
+        """Bulk-add instructions, merging ones similar to stored instructions or to each other."""
+        texts = [text.strip() for text in instruction_texts if text and text.strip()]
+        if not texts:
+            return {"added": 0, "merged": 0}
         
-        # Run in daemon thread to prevent blocking
-        thread = threading.Thread(target=_process, daemon=True)
-        thread.start()
+        with _editing_instructions() as instructions:
+            now = datetime.now()
+            normalized = [_normalize_text(text) for text in texts]
+            existing = [_normalize_text(instr['text']) for instr in instructions]
+            
+            # A blended score of 0.8 needs a character ratio of at least 50 (the Jaccard term
+            # contributes at most 0.6), so one batched C call finds every possible match
+            scores = process.cdist(normalized, existing, scorer=fuzz.ratio, score_cutoff=50, workers=-1) if existing else None
+            
+            upserted = []
+            added = []
+            merged = 0
+            for row, (text, norm) in enumerate(zip(texts, normalized)):
+                candidates = [(existing[col], instructions[col]) for col in scores[row].nonzero()[0]] if scores is not None else []
+                candidates += [(_normalize_text(instr['text']), instr) for instr in added]
+                match = next(
+                    (instr for other, instr in candidates if _similarity_of_normalized(norm, other, min_score=0.8) >= 0.8),
+                    None
+                )
+                
+                if match is not None:
+                    match['usage_count'] = match.get('usage_count', 0) + 1
+                    _mark_used(match, now)
+                    match['effectiveness_score'] = min(match.get('effectiveness_score', 1.0) + 0.1, 5.0)
+                    merged += 1
+                else:
+                    new_instruction = Instruction(
+                        id=f"instr_{now.strftime('%Y%m%d_%H%M%S_%f')}_{len(added)}",
+                        text=text,
+                        created_at=now,
+                        usage_count=1,
+                        category=category
+                    )
+                    new_instruction.extract_keywords()
+                    match = new_instruction.to_dict()
+                    instructions.append(match)
+                    added.append(match)
+                
+                if all(match is not instr for instr in upserted):
+                    upserted.append(match)
+            
+            _record_changes(instructions, upserted=upserted)
+            logger.info(f"Bulk-added {len(added)} instructions ({merged} merged into existing)")
+            return {"added": len(added), "merged": merged}
         
     def clear_session_memory(self, session_id: str):
         """Clear session memory (no-op for global memory with logging)."""
@@ -669,55 +1216,41 @@ class MemoryService:
             logger.error(f"Failed to format instructions: {e}")
             return ""
     
+    def format_instructions_with_ids(self, category: str = None, session_id: str = None) -> Tuple[str, List[str]]:
+        """
+        Same as format_instructions_for_prompt, also returning the ids of the instructions used.
+        Callers that reuse the text from their own cache pass the ids to record_prompt_use.
+        """
+        try:
+            instructions = _load_instructions_cached()
+            
+            if not instructions:
+                return "", []
+            
+            sorted_instructions = _use_prompt_instructions(instructions)
+            return _format_instruction_texts(sorted_instructions), [instr['id'] for instr in sorted_instructions]
+            
+        except Exception as e:
+            logger.error(f"Failed to format instructions: {e}")
+            return "", []
+    
+    def record_prompt_use(self, instruction_ids: List[str]):
+        """Count another prompt use of instructions whose formatted text was reused from a cache."""
+        try:
+            # Bump the current dicts; the list may have been reloaded since the text was cached
+            by_id = _id_index(_load_instructions_cached())
+            _bump_usage([by_id[instr_id] for instr_id in instruction_ids if instr_id in by_id], datetime.now())
+        except Exception as e:
+            logger.warning(f"Failed to record instruction usage: {e}")
+    
     def _format_all_instructions(self, instructions: List[Dict[str, Any]]) -> str:
         """Format ALL instructions for AI prompt - just the text without categories."""
         try:
             if not instructions:
                 return ""
             
-            # Sort by effectiveness, usage, and recency
-            sorted_instructions = sorted(
-                instructions,
-                key=lambda x: (
-                    x.get('effectiveness_score', 1.0) * 0.4 +
-                    min(x.get('usage_count', 0) / 10, 3.0) * 0.4 +
-                    (1.0 if x.get('last_used') and 
-                     (datetime.now() - datetime.fromisoformat(x['last_used'])).days < 7 
-                     else 0.5) * 0.2
-                ),
-                reverse=True
-            )[:8]  # Top 8 instructions
-            
-            # Update usage stats for selected instructions
-            current_time = datetime.now().isoformat()
-            for instr in sorted_instructions:
-                instr['usage_count'] = instr.get('usage_count', 0) + 1
-                instr['last_used'] = current_time
-            
-            # Save updated stats (need to reload full instructions list to update)
-            if sorted_instructions:
-                all_instructions = _load_instructions_cached()
-                # Update the stats in the original instructions list
-                instr_ids = {instr['id']: instr for instr in all_instructions}
-                for updated_instr in sorted_instructions:
-                    if updated_instr['id'] in instr_ids:
-                        instr_ids[updated_instr['id']]['usage_count'] = updated_instr['usage_count']
-                        instr_ids[updated_instr['id']]['last_used'] = updated_instr['last_used']
-                
-                data = {
-                    "instructions": all_instructions,
-                    "last_updated": current_time,
-                    "stats": {"total_instructions": len(all_instructions)}
-                }
-                _save_data_atomically(data, _get_memory_file())
-            
-            # Format for AI prompt - just the instruction text
-            formatted = ["## تعليمات من ذاكرة المستخدم:"]
-            
-            for instr in sorted_instructions:
-                formatted.append(f"• {instr['text']}")
-            
-            return "\n".join(formatted) + "\n"
+            sorted_instructions = _use_prompt_instructions(instructions)
+            return _format_instruction_texts(sorted_instructions)
             
         except Exception as e:
             logger.error(f"Failed to format all instructions: {e}")
@@ -729,59 +1262,10 @@ class MemoryService:
             if not instructions:
                 return ""
             
-            # Sort by effectiveness, usage, and recency
-            sorted_instructions = sorted(
-                instructions,
-                key=lambda x: (
-                    x.get('effectiveness_score', 1.0) * 0.4 +
-                    min(x.get('usage_count', 0) / 10, 3.0) * 0.4 +
-                    (1.0 if x.get('last_used') and 
-                     (datetime.now() - datetime.fromisoformat(x['last_used'])).days < 7 
-                     else 0.5) * 0.2
-                ),
-                reverse=True
-            )[:8]  # Top 8 instructions
-            
-            # Update usage stats for selected instructions
-            current_time = datetime.now().isoformat()
-            for instr in sorted_instructions:
-                instr['usage_count'] = instr.get('usage_count', 0) + 1
-                instr['last_used'] = current_time
-            
-            # Save updated stats (need to reload full instructions list to update)
-            if sorted_instructions:
-                all_instructions = _load_instructions_cached()
-                # Update the stats in the original instructions list
-                instr_ids = {instr['id']: instr for instr in all_instructions}
-                for updated_instr in sorted_instructions:
-                    if updated_instr['id'] in instr_ids:
-                        instr_ids[updated_instr['id']]['usage_count'] = updated_instr['usage_count']
-                        instr_ids[updated_instr['id']]['last_used'] = updated_instr['last_used']
-                
-                data = {
-                    "instructions": all_instructions,
-                    "last_updated": current_time,
-                    "stats": {"total_instructions": len(all_instructions)}
-                }
-                _save_data_atomically(data, _get_memory_file())
+            sorted_instructions = _use_prompt_instructions(instructions)
             
             # Format for AI prompt with categories
-            categories = defaultdict(list)
-            for instr in sorted_instructions:
-                category = instr.get('category', 'general')
-                categories[category].append(instr)
-            
-            formatted = ["## تعليمات من ذاكرة المستخدم:"]
-            
-            for category, instrs in categories.items():
-                if category != 'general':
-                    formatted.append(f"\n### {category}:")
-                for instr in instrs:
-                    effectiveness = instr.get('effectiveness_score', 1.0)
-                    usage = instr.get('usage_count', 0)
-                    formatted.append(f"• {instr['text']} (فعالية: {effectiveness:.1f}, استخدام: {usage})")
-            
-            return "\n".join(formatted) + "\n"
+            return _format_by_category(sorted_instructions)
             
         except Exception as e:
             logger.error(f"Failed to format filtered instructions: {e}")
@@ -793,10 +1277,13 @@ class MemoryService:
 
 # Global service instance
 _memory_service: Optional[MemoryService] = None
+_memory_service_lock = threading.Lock()
 
 def get_memory_service() -> MemoryService:
     """Get the memory service instance."""
     global _memory_service
     if _memory_service is None:
-        _memory_service = MemoryService()
+        with _memory_service_lock:
+            if _memory_service is None:
+                _memory_service = MemoryService()
     return _memory_service
\ No newline at end of file
@@ -0,0 +1,165 @@
+"""
+Letter Response Cache
+SQLite-backed exact-match cache for generated letters, shared by all workers on a host,
+and an in-process semantic cache that reuses letters for near-duplicate prompts.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import closing
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_openai import OpenAIEmbeddings
+
+from ..config import get_config
+from ..models import LetterOutput
+
+logger = logging.getLogger(__name__)
+
+class LetterResponseCache:
+    """
+    Persistent exact-match cache mapping a request fingerprint to a generated letter.
+    Entries older than the TTL are ignored on read and purged on write.
+    """
+
+    def __init__(self, cache_file: str = "data/letter_cache.db", ttl_hours: int = 24):
+        self.cache_file = cache_file
+        self.ttl_seconds = ttl_hours * 3600
+        self._lock = threading.Lock()
+
+        # Ensure data directory exists
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS letter_cache ("
+                "cache_key TEXT PRIMARY KEY, payload TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+
+        logger.info(f"LetterResponseCache initialized at {cache_file} (ttl: {ttl_hours}h)")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection; one per operation keeps the cache safe across threads."""
+        return sqlite3.connect(self.cache_file, timeout=5)
+
+    def get(self, cache_key: str) -> Optional[LetterOutput]:
+        """Get a cached letter, or None if missing or expired."""
+        try:
+            with closing(self._connect()) as conn:
+                row = conn.execute(
+                    "SELECT payload FROM letter_cache WHERE cache_key = ? AND created_at >= ?",
+                    (cache_key, time.time() - self.ttl_seconds)
+                ).fetchone()
+            return LetterOutput.model_validate_json(row[0]) if row else None
+        except Exception as e:
+            logger.warning(f"Letter cache read failed: {e}")
+            return None
+
+    def set(self, cache_key: str, letter: LetterOutput) -> None:
+        """Store a generated letter and purge expired entries."""
+        now = time.time()
+        try:
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO letter_cache (cache_key, payload, created_at) VALUES (?, ?, ?)",
+                    (cache_key, letter.model_dump_json(), now)
+                )
+                conn.execute("DELETE FROM letter_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        except Exception as e:
+            logger.warning(f"Letter cache write failed: {e}")
+
+class SemanticLetterCache:
+    """
+    Bounded in-memory cache matching prompts by embedding similarity.
+    
+    Entries are grouped into buckets by the fingerprint of every other request
+    field, so a letter is only reused when recipient, category, sender and the
+    other inputs match exactly and the prompt wording is nearly the same.
+    """
+    
+    def __init__(self, embeddings: OpenAIEmbeddings, threshold: float = 0.95, max_entries: int = 10_000):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, Tuple[str, np.ndarray, LetterOutput]]" = OrderedDict()
+        self._buckets: Dict[str, List[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+    
+    def embed(self, prompt: str) -> np.ndarray:
+        """Embed a prompt as a unit vector so a dot product is the cosine similarity."""
+        vector = np.asarray(self.embeddings.embed_query(prompt), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def match(self, bucket_key: str, embedding: np.ndarray) -> Optional[LetterOutput]:
+        """Return the most similar cached letter in the bucket if it clears the threshold."""
+        with self._lock:
+            entry_ids = self._buckets.get(bucket_key)
+            if not entry_ids:
+                return None
+            
+            matrix = np.stack([self._entries[entry_id][1] for entry_id in entry_ids])
+            scores = matrix @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            
+            entry_id = entry_ids[best]
+            self._entries.move_to_end(entry_id)
+            logger.debug("Semantic cache hit (similarity %.3f)", scores[best])
+            return self._entries[entry_id][2]
+    
+    def add(self, bucket_key: str, embedding: np.ndarray, letter: LetterOutput) -> None:
+        """Insert a letter, evicting the least recently used entry when full."""
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (bucket_key, embedding, letter)
+            self._buckets.setdefault(bucket_key, []).append(entry_id)
+            
+            while len(self._entries) > self.max_entries:
+                old_id, (old_bucket, _, _) = self._entries.popitem(last=False)
+                bucket = self._buckets[old_bucket]
+                bucket.remove(old_id)
+                if not bucket:
+                    del self._buckets[old_bucket]
+
+# Global instances
+_response_cache = None
+_response_cache_lock = threading.Lock()
+_semantic_cache = None
+_semantic_cache_lock = threading.Lock()
+
+def get_response_cache() -> LetterResponseCache:
+    """Get the global letter response cache instance (singleton)."""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            config = get_config()
+            _response_cache = LetterResponseCache(
+                cache_file=config.storage.response_cache_file,
+                ttl_hours=config.storage.response_cache_ttl_hours
+            )
+        return _response_cache
+
+def get_semantic_cache() -> SemanticLetterCache:
+    """Get the global semantic letter cache instance (singleton, created on first use)."""
+    global _semantic_cache
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            config = get_config()
+            _semantic_cache = SemanticLetterCache(
+                embeddings=OpenAIEmbeddings(
+                    model=config.ai.embedding_model,
+                    openai_api_key=config.openai_api_key
+                ),
+                threshold=config.ai.semantic_cache_threshold,
+                max_entries=config.ai.semantic_cache_size
+            )
+        return _semantic_cache
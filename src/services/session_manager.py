@@ -24,6 +24,7 @@ class SessionManager:
         # Background cleanup
         self.cleanup_thread = None
         self.cleanup_interval = 600  # 10 minutes
+        self.max_cleanup_interval = 3600  # Back-off cap while there is nothing to clean
         self.shutdown_event = threading.Event()
         
         # Statistics
@@ -39,11 +40,19 @@ class SessionManager:
     def _start_background_cleanup(self):
         """Start background cleanup thread."""
         def cleanup_worker():
-            while not self.shutdown_event.wait(self.cleanup_interval):
+            interval = self.cleanup_interval
+            while not self.shutdown_event.wait(interval):
                 try:
+                    if self.storage.session_count() == 0:
+                        continue
+                    
                     result = self.storage.cleanup_expired_sessions()
                     if result["cleaned_sessions"] > 0:
                         logger.info(f"Background cleanup completed: {result}")
+                        interval = self.cleanup_interval
+                    else:
+                        # Nothing expired: wait longer, up to the cap
+                        interval = min(interval * 2, self.max_cleanup_interval)
                 except Exception as e:
                     logger.error(f"Background cleanup error: {e}")
         
@@ -136,23 +145,15 @@ class SessionManager:
     def add_message(self, session_id: str, role: str, content: str, 
                    metadata: Optional[Dict] = None) -> bool:
         """Add a message to a session."""
-        session = self.storage.get_session(session_id)
-        if not session:
-            return False
-        
-        if not self.storage.session_exists(session_id):
-            return False
-        
         message = {
-            "id": f"msg_{len(session.messages) + 1}",
             "role": role,
             "content": content,
             "timestamp": datetime.now().isoformat(),
             "metadata": metadata or {}
         }
         
-        session.messages.append(message)
-        self.storage.update_session_activity(session_id)
+        if self.storage.append_message(session_id, message) is None:
+            return False
         
         # Update statistics
         with self._stats_lock:
@@ -163,24 +164,13 @@ class SessionManager:
     def add_letter_version(self, session_id: str, content: str, 
                           change_summary: str = "") -> bool:
         """Add a letter version to a session."""
-        session = self.storage.get_session(session_id)
-        if not session:
-            return False
-        
-        if not self.storage.session_exists(session_id):
-            return False
-        
         version = {
-            "version_id": f"v_{len(session.letter_versions) + 1}",
             "content": content,
             "timestamp": datetime.now().isoformat(),
             "change_summary": change_summary
         }
         
-        session.letter_versions.append(version)
-        self.storage.update_session_activity(session_id)
-        
-        return True
+        return self.storage.append_letter_version(session_id, version) is not None
     
     def get_chat_history(self, session_id: str, limit: int = 50, 
                         offset: int = 0) -> List[Dict[str, Any]]:
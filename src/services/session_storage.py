@@ -3,7 +3,6 @@ Dedicated Session Storage Service
 Separate service focused solely on session persistence and retrieval.
 """
 
-import json
 import os
 import threading
 import time
@@ -13,8 +12,19 @@ from dataclasses import dataclass, field
 import uuid
 import logging
 
+import orjson
+
 logger = logging.getLogger(__name__)
 
+def _next_sequence(entries: List[Dict], id_key: str) -> int:
+    """Next free number for ids like msg_<n> / v_<n>, continuing after the highest one in use."""
+    highest = len(entries)
+    for entry in entries:
+        suffix = str(entry.get(id_key, "")).rpartition("_")[2]
+        if suffix.isdigit():
+            highest = max(highest, int(suffix))
+    return highest + 1
+
 @dataclass
 class SessionData:
     """Session data structure."""
@@ -27,6 +37,9 @@ class SessionData:
     idempotency_key: Optional[str] = None
     messages: List[Dict] = field(default_factory=list)
     letter_versions: List[Dict] = field(default_factory=list)
+    # Sequence numbers for new message/version ids (never reused)
+    next_message_id: int = 1
+    next_version_id: int = 1
     
     def to_dict(self) -> Dict[str, Any]:
         """Convert to dictionary for JSON serialization."""
@@ -39,12 +52,16 @@ class SessionData:
             "is_active": self.is_active,
             "idempotency_key": self.idempotency_key,
             "messages": self.messages,
-            "letter_versions": self.letter_versions
+            "letter_versions": self.letter_versions,
+            "next_message_id": self.next_message_id,
+            "next_version_id": self.next_version_id
         }
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'SessionData':
         """Create from dictionary."""
+        messages = data.get("messages", [])
+        letter_versions = data.get("letter_versions", [])
         return cls(
             session_id=data["session_id"],
             created_at=datetime.fromisoformat(data["created_at"]),
@@ -53,8 +70,10 @@ class SessionData:
             context=data["context"],
             is_active=data.get("is_active", True),
             idempotency_key=data.get("idempotency_key"),
-            messages=data.get("messages", []),
-            letter_versions=data.get("letter_versions", [])
+            messages=messages,
+            letter_versions=letter_versions,
+            next_message_id=data.get("next_message_id", _next_sequence(messages, "id")),
+            next_version_id=data.get("next_version_id", _next_sequence(letter_versions, "version_id"))
         )
 
 class SessionStorage:
@@ -82,8 +101,8 @@ class SessionStorage:
         try:
             with self._file_lock:
                 if os.path.exists(self.storage_file):
-                    with open(self.storage_file, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
+                    with open(self.storage_file, 'rb') as f:
+                        data = orjson.loads(f.read())
                         
                     loaded_sessions = {}
                     loaded_count = 0
@@ -130,8 +149,8 @@ class SessionStorage:
             with self._file_lock:
                 # Use atomic write with temporary file
                 temp_file = self.storage_file + '.tmp'
-                with open(temp_file, 'w', encoding='utf-8') as f:
-                    json.dump(sessions_snapshot, f, ensure_ascii=False, indent=2)
+                with open(temp_file, 'wb') as f:
+                    f.write(orjson.dumps(sessions_snapshot, option=orjson.OPT_INDENT_2))
                 
                 # Atomic rename
                 if os.path.exists(self.storage_file):
@@ -184,21 +203,29 @@ class SessionStorage:
         with self._lock:
             return self._sessions.get(session_id)
     
-    def session_exists(self, session_id: str) -> bool:
-        """Check if session exists and is not expired."""
+    def get_active_session(self, session_id: str) -> Optional[SessionData]:
+        """Get a session only if it exists, is active and is not expired."""
         # Reload from disk to get latest sessions from all workers
         self._load_from_disk()
         
         with self._lock:
-            session = self._sessions.get(session_id)
-            if not session:
-                return False
+            return self._find_active_session(session_id)
+    
+    def _find_active_session(self, session_id: str) -> Optional[SessionData]:
+        """Look up an active, unexpired session in memory (caller holds _lock)."""
+        session = self._sessions.get(session_id)
+        if not session:
+            return None
+        
+        # Check if expired (but don't delete here)
+        if datetime.now() > session.expires_at:
+            return None
             
-            # Check if expired (but don't delete here)
-            if datetime.now() > session.expires_at:
-                return False
-                
-            return session.is_active
+        return session if session.is_active else None
+    
+    def session_exists(self, session_id: str) -> bool:
+        """Check if session exists and is not expired."""
+        return self.get_active_session(session_id) is not None
     
     def list_sessions(self, include_expired: bool = False) -> List[Dict[str, Any]]:
         """List all sessions."""
@@ -247,6 +274,42 @@ class SessionStorage:
                 return True
             return False
     
+    def append_message(self, session_id: str, message: Dict[str, Any]) -> Optional[str]:
+        """Number and append a message to an active session and save it. Returns the new message id."""
+        # Reload from disk to get latest sessions from all workers
+        self._load_from_disk()
+        
+        with self._lock:
+            # Look up and mutate the stored object in one step; a reload would discard
+            # changes made to a session returned by an earlier call
+            session = self._find_active_session(session_id)
+            if not session:
+                return None
+            
+            message_id = f"msg_{session.next_message_id}"
+            session.next_message_id += 1
+            session.messages.append({"id": message_id, **message})
+            session.last_activity = datetime.now()
+            self._save_to_disk()
+            return message_id
+    
+    def append_letter_version(self, session_id: str, version: Dict[str, Any]) -> Optional[str]:
+        """Number and append a letter version to an active session and save it. Returns the new version id."""
+        # Reload from disk to get latest sessions from all workers
+        self._load_from_disk()
+        
+        with self._lock:
+            session = self._find_active_session(session_id)
+            if not session:
+                return None
+            
+            version_id = f"v_{session.next_version_id}"
+            session.next_version_id += 1
+            session.letter_versions.append({"version_id": version_id, **version})
+            session.last_activity = datetime.now()
+            self._save_to_disk()
+            return version_id
+    
     def extend_session_expiration(self, session_id: str, new_expires_at: datetime) -> bool:
         """Update session expiration time."""
         # Reload from disk to get latest sessions from all workers
@@ -318,6 +381,11 @@ class SessionStorage:
                 "storage_file": self.storage_file
             }
     
+    def session_count(self) -> int:
+        """Number of sessions held in memory."""
+        with self._lock:
+            return len(self._sessions)
+    
     def find_by_idempotency_key(self, idempotency_key: str) -> Optional[str]:
         """Find session by idempotency key."""
         with self._lock:
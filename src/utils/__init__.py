@@ -43,9 +43,11 @@ from .exceptions import (
     handle_storage_errors,
     handle_session_errors,
     service_error_handler,
+    instrument,
     
     # Utilities
     ErrorContext,
+    tag_operation,
     build_error_response,
     log_error_with_context,
     validate_and_raise,
@@ -95,7 +97,9 @@ __all__ = [
     "handle_storage_errors", 
     "handle_session_errors",
     "service_error_handler",
+    "instrument",
     "ErrorContext",
+    "tag_operation",
     "build_error_response",
     "log_error_with_context",
     "validate_and_raise",
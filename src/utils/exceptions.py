@@ -3,8 +3,10 @@ Exception handling utilities for the AutomatingLetter application.
 Custom exceptions and error handling decorators.
 """
 
+import time
 import logging
 import traceback
+from contextvars import ContextVar
 from typing import Optional, Dict, Any, Callable
 from functools import wraps
 from datetime import datetime
@@ -96,6 +98,36 @@ def handle_exceptions(
         return wrapper
     return decorator
 
+def _convert_ai_service_error(func: Callable, args: tuple, kwargs: dict, e: Exception) -> AutomatingLetterException:
+    """Map an exception raised by an AI service call to the matching custom exception."""
+    error_details = {
+        "function": func.__name__,
+        "args_count": len(args),
+        "kwargs_keys": list(kwargs.keys()),
+        "original_error": str(e),
+        "error_type": type(e).__name__
+    }
+    
+    # Check for specific error types
+    if "rate limit" in str(e).lower():
+        return RateLimitError(
+            "AI service rate limit exceeded",
+            error_code="RATE_LIMIT_EXCEEDED",
+            details=error_details
+        )
+    elif "authentication" in str(e).lower() or "api key" in str(e).lower():
+        return AuthenticationError(
+            "AI service authentication failed",
+            error_code="AUTH_FAILED",
+            details=error_details
+        )
+    else:
+        return AIServiceError(
+            f"AI service error: {str(e)}",
+            error_code="AI_SERVICE_ERROR",
+            details=error_details
+        )
+
 def handle_ai_service_errors(func: Callable) -> Callable:
     """Decorator specifically for handling AI service errors."""
     @wraps(func)
@@ -103,33 +135,7 @@ def handle_ai_service_errors(func: Callable) -> Callable:
         try:
             return func(*args, **kwargs)
         except Exception as e:
-            error_details = {
-                "function": func.__name__,
-                "args_count": len(args),
-                "kwargs_keys": list(kwargs.keys()),
-                "original_error": str(e),
-                "error_type": type(e).__name__
-            }
-            
-            # Check for specific error types
-            if "rate limit" in str(e).lower():
-                raise RateLimitError(
-                    "AI service rate limit exceeded",
-                    error_code="RATE_LIMIT_EXCEEDED",
-                    details=error_details
-                )
-            elif "authentication" in str(e).lower() or "api key" in str(e).lower():
-                raise AuthenticationError(
-                    "AI service authentication failed",
-                    error_code="AUTH_FAILED",
-                    details=error_details
-                )
-            else:
-                raise AIServiceError(
-                    f"AI service error: {str(e)}",
-                    error_code="AI_SERVICE_ERROR",
-                    details=error_details
-                )
+            raise _convert_ai_service_error(func, args, kwargs, e)
     return wrapper
 
 def handle_storage_errors(func: Callable) -> Callable:
@@ -279,6 +285,55 @@ class ErrorContext:
         
         return False  # Don't suppress exceptions
 
+# Fused instrumentation for hot service paths
+_operation_tags: ContextVar[Optional[Dict[str, Any]]] = ContextVar("operation_tags", default=None)
+
+def tag_operation(**tags) -> None:
+    """Attach context tags to the operation currently running under @instrument."""
+    current = _operation_tags.get()
+    if current is None:
+        _operation_tags.set(tags)
+    else:
+        current.update(tags)
+
+def instrument(operation: str) -> Callable:
+    """
+    Decorator fusing AI error handling, timing and operation context for hot paths.
+    
+    Equivalent to stacking handle_ai_service_errors, measure_performance and an
+    ErrorContext, but with a single wrapper frame. Context is collected through
+    tag_operation() and is only formatted if the call fails.
+    
+    Args:
+        operation: Operation name used in log records
+    """
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            token = _operation_tags.set(None)
+            start_ns = time.perf_counter_ns()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                duration = (time.perf_counter_ns() - start_ns) / 1e9
+                logger.error(f"Operation failed: {operation} ({func.__name__} after {duration:.3f}s): {e}", extra={
+                    "operation": operation,
+                    "duration_seconds": duration,
+                    "context": _operation_tags.get() or {},
+                    "error_type": type(e).__name__,
+                    "error_message": str(e)
+                }, exc_info=True)
+                raise _convert_ai_service_error(func, args, kwargs, e)
+            finally:
+                _operation_tags.reset(token)
+            
+            if logger.isEnabledFor(logging.INFO):
+                duration = (time.perf_counter_ns() - start_ns) / 1e9
+                logger.info(f"{func.__name__} executed in {duration:.3f}s")
+            return result
+        return wrapper
+    return decorator
+
 # Error Response Builders
 def build_error_response(
     error: Exception,
@@ -35,20 +35,20 @@ def generate_session_id() -> str:
     return str(uuid.uuid4())
 
 # Date and Time Utilities
+_ARABIC_MONTHS = (
+    "يناير", "فبراير", "مارس", "أبريل",
+    "مايو", "يونيو", "يوليو", "أغسطس",
+    "سبتمبر", "أكتوبر", "نوفمبر", "ديسمبر"
+)
+_ARABIC_NUMERALS = str.maketrans('0123456789', '٠١٢٣٤٥٦٧٨٩')
+
 def get_current_arabic_date() -> str:
     """Get current date in Arabic format."""
-    months_arabic = {
-        1: "يناير", 2: "فبراير", 3: "مارس", 4: "أبريل",
-        5: "مايو", 6: "يونيو", 7: "يوليو", 8: "أغسطس",
-        9: "سبتمبر", 10: "أكتوبر", 11: "نوفمبر", 12: "ديسمبر"
-    }
-    
     now = datetime.now()
-    arabic_numerals = str.maketrans('0123456789', '٠١٢٣٤٥٦٧٨٩')
     
-    day = str(now.day).translate(arabic_numerals)
-    month = months_arabic[now.month]
-    year = str(now.year).translate(arabic_numerals)
+    day = str(now.day).translate(_ARABIC_NUMERALS)
+    month = _ARABIC_MONTHS[now.month - 1]
+    year = str(now.year).translate(_ARABIC_NUMERALS)
     
     return f"{day} {month} {year}"
 